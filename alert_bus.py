@@ -0,0 +1,68 @@
+"""
+Wake-up channel from web-api.py to the Telegram bot (k-defender.py).
+
+Alerts and info messages are queued in storage (record_check with an alert,
+push_pending), which is the durable outbox: nothing is lost while the bot is
+down. After queueing, the API sends an empty datagram to a unix socket the
+bot listens on; the bot wakes up, pops the pending items and delivers them.
+
+    notify()                  # web-api.py, after the storage write
+    wakeup = listen()         # k-defender.py, inside the event loop
+    await wakeup.wait(); wakeup.clear()
+
+No polling: an idle bot does no work, and delivery starts within a
+millisecond of the check. A datagram sent while the bot isn't listening is
+simply dropped; the bot drains the outbox when it starts.
+"""
+import asyncio
+import os
+import socket
+
+from klog import get_logger
+
+log = get_logger("alert_bus")
+
+ALERT_SOCKET = os.getenv("KDEFENDER_ALERT_SOCKET", "kdefender-alerts.sock")
+
+_sock = None
+
+
+def notify(path=ALERT_SOCKET):
+    """Wakes the bot up. Never blocks and never fails the caller."""
+    global _sock
+    try:
+        if _sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            _sock = sock
+        _sock.sendto(b"", path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass  # bot not running: it drains the outbox on start
+    except BlockingIOError:
+        pass  # bot's queue full: it has a wake-up pending already
+    except OSError as e:
+        # bad path, socket of another user...: the alert is stored, only the wake-up is lost
+        log.warning("alert_notify_error", path=path, error=str(e))
+
+
+def listen(path=ALERT_SOCKET):
+    """asyncio.Event set whenever notify() is called (bind before the first drain)."""
+    if os.path.exists(path):
+        os.remove(path)  # stale socket of a previous run
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(path)
+    os.chmod(path, 0o600)
+
+    wakeup = asyncio.Event()
+
+    def on_readable():
+        try:
+            while True:
+                sock.recv(1)
+        except BlockingIOError:
+            pass
+        wakeup.set()
+
+    asyncio.get_running_loop().add_reader(sock, on_readable)
+    return wakeup
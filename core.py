@@ -1,14 +1,29 @@
 import time
 import json
 import os
+import re
 import hashlib
 import secrets
-import joblib
-from collections import defaultdict
+import threading
+import queue
+from collections import Counter
+from normalization import normalize_input, get_transform_stats
+from model_registry import read_manifest, load_version
+from inference_server import InferenceClient
+from ratelimit import ShardedLimiter
+from storage import get_store
+from klog import get_logger
+
+log = get_logger("core")
 
-STATE_FILE = "state.json"
 SIG_FILE = "signatures.json"
 MODEL_FILE = "kdefender_ai.pkl"
+# written by train_model.py, scored without sklearn (kdefender_ai_hashed.npz for the hashed variant)
+NATIVE_MODEL_FILE = os.getenv("KDEFENDER_NATIVE_MODEL", "kdefender_ai.npz")
+MODEL_BACKEND = os.getenv("KDEFENDER_MODEL_BACKEND", "auto")  # auto / native / sklearn
+# joblib (uncompressed dump) and NativeScorer (.npz) memory-map the numpy arrays,
+# so forked workers share them instead of each holding a copy ("" -> load into memory)
+MODEL_MMAP_MODE = os.getenv("KDEFENDER_MODEL_MMAP", "r") or None
 
 # ================= SETTINGS =================
 
@@ -42,39 +57,101 @@ def load_json(path, default):
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def save_json(path, data):
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-    os.replace(tmp, path)
-
-state = load_json(STATE_FILE, {})
+store = get_store()  # KDEFENDER_STORAGE: json (state.json) / sharded / sqlite; rows are read per check
 signatures = load_json(SIG_FILE, {})
 
 # ================= MODEL LOAD =================
-try:
-    model = joblib.load(MODEL_FILE)
-    print("[AI] Model loaded.")
-except Exception as e:
-    print(f"[AI] Could not load model: {e}")
-    model = None
 
-# ================= USER/BOT =================
+# loaded lazily by the AI stage, so check = "file" never pays for it
+model = None
+model_version = None
+_previous_model = None  # (model, version), kept for instant rollback
+_model_loaded = False
+_model_lock = threading.Lock()
+
+MODEL_POLL = float(os.getenv("KDEFENDER_MODEL_POLL", "5"))  # seconds between manifest checks
+_watcher_pid = None
+
+def _load_model():
+    """-> (model, version). The registry's active version wins over the plain files."""
+    manifest = read_manifest()
+    if manifest and manifest.get("active"):
+        version = manifest["active"]
+        return load_version(version, mmap_mode=MODEL_MMAP_MODE), version
+
+    use_native = MODEL_BACKEND == "native" or (
+        MODEL_BACKEND == "auto" and os.path.exists(NATIVE_MODEL_FILE)
+    )
+    if use_native:
+        from native_model import NativeScorer
+        return NativeScorer(NATIVE_MODEL_FILE, mmap_mode=MODEL_MMAP_MODE), "legacy"
+
+    import joblib
+    return joblib.load(MODEL_FILE, mmap_mode=MODEL_MMAP_MODE), "legacy"
+
+def get_model():
+    global model, model_version, _model_loaded
+    if _model_loaded:
+        return model
+
+    with _model_lock:
+        if not _model_loaded:
+            try:
+                model, model_version = _load_model()
+                log.info("model_loaded", version=model_version)
+            except Exception as e:
+                log.error("model_load_failed", error=str(e))
+                model = None
+            _model_loaded = True
+
+    return model
+
+def swap_model(new_model, version):
+    global model, model_version, _previous_model
+    with _model_lock:
+        _previous_model = (model, model_version)
+        model, model_version = new_model, version
+
+def reload_model_if_changed():
+    """
+    Switches to the manifest's active version: loads and warms it
+    first, then swaps the reference. Rolling back to the previous
+    version reuses the copy still in memory.
+    """
+    if not _model_loaded:
+        return False  # the first get_model() reads the manifest anyway
+
+    manifest = read_manifest()
+    active = manifest and manifest.get("active")
+    if not active or active == model_version:
+        return False
+
+    if _previous_model and _previous_model[1] == active:
+        swap_model(*_previous_model)
+    else:
+        new_model = load_version(active, mmap_mode=MODEL_MMAP_MODE)
+        new_model.predict_proba(["warmup"])
+        swap_model(new_model, active)
+
+    log.info("model_switched", version=active)
+    return True
+
+def _watch_models():
+    while True:
+        time.sleep(MODEL_POLL)
+        try:
+            reload_model_if_changed()
+        except Exception:
+            log.exception("model_reload_failed")
+
+def start_model_watcher():
+    global _watcher_pid
+    if _watcher_pid == os.getpid():
+        return
+    _watcher_pid = os.getpid()
+    threading.Thread(target=_watch_models, daemon=True).start()
 
-def ensure_user(uid):
-    u = state.setdefault(str(uid), {})
-    u.setdefault("bots", {})
-    u.setdefault("settings", DEFAULT_USER_SETTINGS.copy())
-    return u
-
-def ensure_bot(uid, bot_id):
-    u = ensure_user(uid)
-    b = u["bots"].setdefault(str(bot_id), {})
-    b.setdefault("settings", DEFAULT_BOT_SETTINGS.copy())
-    b.setdefault("stats_total", 0)
-    b.setdefault("stats_blocked", 0)
-    b.setdefault("logs", [])
-    return b
+# ================= USER/BOT =================
 
 def generate_bot_token(bot_username):
     return hashlib.sha256(
@@ -85,17 +162,14 @@ def generate_bot_token(bot_username):
 
 FLOOD_WINDOW = 5      # seconds
 FLOOD_LIMIT = 6       # messages
+FLOOD_SHARDS = 64
+FLOOD_MAX_KEYS = int(os.getenv("KDEFENDER_FLOOD_MAX_KEYS", "500000"))  # active senders kept
 
-def detect_flood(user_state, bot_id):
-    now = time.time()
-    flood = user_state.setdefault("Flood", defaultdict(list))
-    logs = flood[bot_id]
-
-    # очищаем старые
-    logs[:] = [t for t in logs if now - t < FLOOD_WINDOW]
-    logs.append(now)
+flood_limiter = ShardedLimiter(FLOOD_LIMIT, FLOOD_WINDOW, FLOOD_SHARDS, max_keys=FLOOD_MAX_KEYS)
 
-    return len(logs) >= FLOOD_LIMIT
+def detect_flood(bot_id, sender=None):
+    """Per (bot, sender); wrappers that don't send the sender share one counter per bot."""
+    return flood_limiter.hit((str(bot_id), "" if sender is None else str(sender)))
 
 # ================= SIGNATURE DETECTION =================
 
@@ -112,37 +186,254 @@ def detect_signature(text):
 
     return report
 
+# ================= AI BATCHING =================
+
+AI_BATCH_WINDOW_MS = float(os.getenv("KDEFENDER_AI_BATCH_MS", "0"))  # 0 -> no batching
+AI_BATCH_MAX = int(os.getenv("KDEFENDER_AI_BATCH_MAX", "32"))
+AI_TOP_K = int(os.getenv("KDEFENDER_AI_TOP_K", "3"))  # normalization candidates scored by the model
+
+# model in a separate process (inference_server.py); this process never loads it
+INFERENCE_SOCKET = os.getenv("KDEFENDER_INFERENCE_SOCKET", "")
+inference_client = InferenceClient(INFERENCE_SOCKET) if INFERENCE_SOCKET else None
+
+def predict_batch(texts, model=None):
+    """
+    One predict_proba call for several texts -> [(label, confidence), ...]
+    Without a model, goes to the inference service if one is configured.
+    """
+    global model_version
+    if model is None and inference_client is not None:
+        results = inference_client.predict(texts)
+        model_version = inference_client.version
+        return results
+
+    if model is None:
+        model = get_model()
+    probs = model.predict_proba(texts)
+    classes = model.classes_
+    best = probs.argmax(axis=1)
+    return [(classes[i], probs[row, i]) for row, i in enumerate(best)]
+
+class InferenceQueue:
+    """
+    Collects texts from concurrent callers for up to window_ms
+    (or max_batch items) and scores them with one predict_batch call.
+    """
+
+    def __init__(self, window_ms, max_batch):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.batch_sizes = Counter()  # batch size -> number of batches
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_worker(self):
+        # threads don't survive fork: a forked process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, text):
+        return self.submit_many([text])[0]
+
+    def submit_many(self, texts):
+        self._ensure_worker()
+        items = [{"text": t, "done": threading.Event(), "result": None, "error": None} for t in texts]
+        for item in items:
+            self._queue.put(item)
+        for item in items:
+            item["done"].wait()
+            if item["error"] is not None:
+                raise item["error"]
+        return [item["result"] for item in items]
+
+    def _run(self):
+        q = self._queue
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.batch_sizes[len(batch)] += 1
+
+            try:
+                results = predict_batch([item["text"] for item in batch])
+                for item, result in zip(batch, results):
+                    item["result"] = result
+            except Exception as e:
+                for item in batch:
+                    item["error"] = e
+
+            for item in batch:
+                item["done"].set()
+
+    def stats(self):
+        return dict(sorted(self.batch_sizes.items()))
+
+ai_queue = InferenceQueue(AI_BATCH_WINDOW_MS, AI_BATCH_MAX)
+# a process pool worker runs one check at a time: nothing to merge, the window would only add latency
+ai_batching = AI_BATCH_WINDOW_MS > 0
+
 # ================= AI DETECTION =================
 
-def detect_ai(text):
-    if not model:
-        return {}
+def detect_ai(text, candidates=None):
+    """
+    Scores text plus the other normalization candidates in one
+    predict_proba call; the most confident attack label wins.
+    """
+    model = None
+    if inference_client is None:
+        model = get_model()
+        if not model:
+            return {}
+
+    texts = list(dict.fromkeys([text, *(candidates or [])]))
 
     try:
-        probs = model.predict_proba([text])[0]
-        classes = model.classes_
+        if ai_batching:
+            results = ai_queue.submit_many(texts)
+        else:
+            results = predict_batch(texts, model)
 
-        best_idx = probs.argmax()
-        best_label = classes[best_idx]
-        confidence = probs[best_idx]
+        report = {}
+        worst = 0
 
-        print(f"[AI] Text: {text}")
-        print(f"[AI] Best label: {best_label}")
-        print(f"[AI] Confidence: {confidence}")
+        for t, (best_label, confidence) in zip(texts, results):
+            log.debug("ai_result", text=t, label=str(best_label), confidence=float(confidence))
 
-        # если модель не уверена → считаем безопасным
-        if best_label == "Safe":
-            return {}
+            # если модель не уверена → считаем безопасным
+            if best_label == "Safe":
+                continue
 
-        if confidence < 0.80:   # ← вот ключевой момент
-            return {}
+            if confidence < 0.80:   # ← вот ключевой момент
+                continue
 
-        return {str(best_label): True}
+            if confidence > worst:
+                worst = confidence
+                report = {str(best_label): True}
 
-    except Exception as e:
-        print(f"[AI ERROR] {e}")
+        return report
+
+    except Exception:
+        log.exception("ai_error")
         return {}
 
+# ================= CASCADE =================
+
+# bare commands that never need the model (plus per-bot bot["safe_commands"])
+SAFE_COMMANDS = {"/start", "/help", "/settings", "/stats", "/register", "/login", "/profile"}
+_COMMAND_RE = re.compile(r"^(/[a-z0-9_]+)(?:@[a-z0-9_]+)?$")
+
+def block_threshold(user_settings):
+    return 30 if user_settings.get("strict") else 50
+
+def make_cascade(user_settings, bot):
+    """Cascade policy for a bot, None if switched off (bot["cascade"] = False)."""
+    if not bot.get("cascade", True):
+        return None
+    return {
+        "threshold": block_threshold(user_settings),
+        "settings": bot.get("settings", {}),
+        "safe_commands": list(bot.get("safe_commands", [])),
+    }
+
+def is_safe_command(text, extra=()):
+    m = _COMMAND_RE.match(text.strip().lower())
+    return bool(m) and (m.group(1) in SAFE_COMMANDS or m.group(1) in extra)
+
+def model_needed(text, sig_report, cascade):
+    """hybrid: the model only runs when the signature result is inconclusive"""
+    if cascade is None:
+        return True
+
+    enabled = {k: v for k, v in sig_report.items() if cascade["settings"].get(k, False)}
+
+    # signatures alone already block
+    if get_risk_score(enabled) >= cascade["threshold"]:
+        return False
+
+    # known-safe command, nothing matched
+    if not sig_report and is_safe_command(text, cascade["safe_commands"]):
+        return False
+
+    return True
+
+# ================= CONTENT DETECTION =================
+
+def detect_content(text, cascade=None, candidates=None):
+    """
+    Signature + AI stages. Doesn't touch state, so it is safe
+    to run in a worker process.
+    In hybrid mode with a cascade policy the model is skipped
+    when the signatures already decide.
+    candidates: other normalization variants, scored by the model too.
+    """
+    global check
+    check_mode = check
+
+    report = {}
+
+    # --- Signature ---
+    if check_mode in ["file", "hybrid"]:
+        report.update(detect_signature(text))
+
+    # --- AI ---
+    if check_mode == "ai" or (check_mode == "hybrid" and model_needed(text, report, cascade)):
+        report.update(detect_ai(text, candidates))
+
+    return report
+
+def analyze_text(text, detect=True, disabled_decoders=(), cascade=None):
+    """
+    normalize_input + detect_content in one call (worker entry point).
+    Returns (normalized, content_report or None, model version).
+    """
+    candidates = normalize_input(
+        text,
+        disabled_decoders=disabled_decoders,
+        return_all_candidates=True
+    )
+    normalized = candidates[0]["text"] if candidates else ""
+    if not detect:
+        return normalized, None, model_version
+
+    others = [c["text"] for c in candidates[1:AI_TOP_K]]
+    return normalized, detect_content(normalized, cascade, others), model_version
+
+def analyze_text_in_worker(text, detect=True, disabled_decoders=(), cascade=None):
+    """
+    analyze_text for pool workers: the result plus the worker's transform
+    counters since its previous task (then reset), merged by the API process.
+    """
+    return analyze_text(text, detect, disabled_decoders, cascade), get_transform_stats(reset=True)
+
+def init_pool_worker():
+    """ProcessPoolExecutor initializer: direct predict_batch calls, model loaded."""
+    global ai_batching
+    ai_batching = False
+    warm_up()
+
+def warm_up():
+    """
+    Load the model (if the AI stage is used) and run a dummy prediction.
+    Call before reporting ready / before forking workers.
+    """
+    if check in ["ai", "hybrid"]:
+        detect_ai("warmup")
+        if inference_client is None:
+            start_model_watcher()
+
 # ================= RISK SCORE =================
 
 def get_risk_score(report):
@@ -153,31 +444,21 @@ def get_risk_score(report):
 
 # ================= MAIN DETECTOR =================
 
-def detect_injection(uid, bot_id, text):
-    user = ensure_user(uid)
-    bot = ensure_bot(uid, bot_id)
-
-    if not user["settings"]["enabled"]:
+def detect_injection(uid, bot_id, text, user, bot, content_report=None, sender=None):
+    # user / bot: the rows the API already read from storage (store.find_bot)
+    if not user["settings"].get("enabled", True):
         return {}
 
     final_report = {}
 
     # --- Flood ---
-    if bot["settings"].get("Flood") and detect_flood(user, bot_id):
+    if bot["settings"].get("Flood") and detect_flood(bot_id, sender):
         final_report["Flood"] = True
 
-    global check
-    check_mode = check
-
-    # --- Signature ---
-    if check_mode in ["file", "hybrid"]:
-        sig_report = detect_signature(text)
-        final_report.update(sig_report)
-
-    # --- AI ---
-    if check_mode in ["ai", "hybrid"]:
-        ai_report = detect_ai(text)
-        final_report.update(ai_report)
+    # --- Signature / AI (may be precomputed in a worker) ---
+    if content_report is None:
+        content_report = detect_content(text, make_cascade(user["settings"], bot))
+    final_report.update(content_report)
 
     # --- Apply bot settings ---
     final_report = {
@@ -186,14 +467,11 @@ def detect_injection(uid, bot_id, text):
     }
 
     # --- Strict mode ---
-    if user["settings"]["strict"] and final_report:
-        bot["stats_blocked"] += 1
-        bot["logs"].append({
+    if user["settings"].get("strict", False) and final_report:
+        store.record_check(uid, bot_id, entry={
             "text": text,
             "report": final_report,
             "time": time.time()
-        })
-
-    save_json(STATE_FILE, state)
+        }, total=0, blocked=1)
 
     return final_report
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""
+On-disk training dataset: JSONL shards + manifest.
+
+dataset/
+  manifest.json      {"format": "jsonl", "samples": N, "labels": {label: count}, "shards": [...]}
+  part-00000.jsonl   one {"text": ..., "label": ...} per line
+
+make_dataset.py writes it with ShardWriter, train_model.py reads it either
+whole (load_dataset) or in bounded chunks (iter_chunks).
+"""
+import hashlib
+import json
+import os
+from collections import Counter
+
+DATASET_DIR = "dataset"
+MANIFEST_FILE = "manifest.json"
+SHARD_SIZE = 100_000
+
+
+class ShardWriter:
+    def __init__(self, path=DATASET_DIR, shard_size=SHARD_SIZE):
+        self.path = path
+        self.shard_size = shard_size
+        self.shards = []
+        self.labels = Counter()
+        self._file = None
+        self._in_shard = 0
+
+        os.makedirs(path, exist_ok=True)
+        # старые шарды не должны смешаться с новыми
+        for name in os.listdir(path):
+            if name.startswith("part-") and name.endswith(".jsonl"):
+                os.remove(os.path.join(path, name))
+
+    def _next_shard(self):
+        if self._file:
+            self._file.close()
+        name = "part-%05d.jsonl" % len(self.shards)
+        self.shards.append(name)
+        self._file = open(os.path.join(self.path, name), "w", encoding="utf-8")
+        self._in_shard = 0
+
+    def write(self, text, label):
+        if self._file is None or self._in_shard >= self.shard_size:
+            self._next_shard()
+        self._file.write(json.dumps({"text": text, "label": label}, ensure_ascii=False) + "\n")
+        self._in_shard += 1
+        self.labels[label] += 1
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+        manifest = {
+            "format": "jsonl",
+            "samples": sum(self.labels.values()),
+            "labels": dict(self.labels),
+            "shards": self.shards,
+        }
+        tmp = os.path.join(self.path, MANIFEST_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.path, MANIFEST_FILE))
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_manifest(path=DATASET_DIR):
+    with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def dataset_hash(path=DATASET_DIR):
+    """sha256 over the manifest and every shard: changes whenever the data does."""
+    h = hashlib.sha256()
+    with open(os.path.join(path, MANIFEST_FILE), "rb") as f:
+        h.update(f.read())
+    for name in read_manifest(path)["shards"]:
+        with open(os.path.join(path, name), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def iter_samples(path=DATASET_DIR):
+    """(text, label) pairs, one shard open at a time."""
+    for name in read_manifest(path)["shards"]:
+        with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                yield row["text"], row["label"]
+
+
+def iter_chunks(path=DATASET_DIR, chunk_size=10_000):
+    """(texts, labels) lists of at most chunk_size samples."""
+    texts, labels = [], []
+    for text, label in iter_samples(path):
+        texts.append(text)
+        labels.append(label)
+        if len(texts) >= chunk_size:
+            yield texts, labels
+            texts, labels = [], []
+    if texts:
+        yield texts, labels
+
+
+def load_dataset(path=DATASET_DIR):
+    texts, labels = [], []
+    for text, label in iter_samples(path):
+        texts.append(text)
+        labels.append(label)
+    return texts, labels
@@ -0,0 +1,171 @@
+"""
+Out-of-process inference: a service that owns the model and scores batches
+of texts for the API processes over a unix socket, so model CPU (and its GIL)
+is isolated from request handling and scales on its own.
+
+    python inference_server.py --socket /tmp/kdefender-ai.sock --workers 2
+
+API side: KDEFENDER_INFERENCE_SOCKET=/tmp/kdefender-ai.sock
+
+Protocol (both directions): 4-byte big-endian length + JSON.
+    -> {"texts": [...]}
+    <- {"results": [[label, confidence], ...], "version": "..."} or {"error": "..."}
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+_HEADER = struct.Struct(">I")
+MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def send_msg(sock, data):
+    payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("inference socket closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_msg(sock):
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if size > MAX_MESSAGE:
+        raise ValueError("inference message too large")
+    return json.loads(_recv_exact(sock, size).decode("utf-8"))
+
+
+# ================= CLIENT =================
+
+class InferenceClient:
+    """One persistent connection per thread; reconnects once on failure."""
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.version = None
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self._local.sock = sock
+        self._local.pid = os.getpid()
+        return sock
+
+    def _sock(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None or self._local.pid != os.getpid():
+            sock = self._connect()
+        return sock
+
+    def predict(self, texts):
+        """-> [(label, confidence), ...]"""
+        for attempt in (1, 2):
+            try:
+                sock = self._sock()
+                send_msg(sock, {"texts": list(texts)})
+                reply = recv_msg(sock)
+                break
+            except (OSError, ConnectionError):
+                self._local.sock = None
+                if attempt == 2:
+                    raise
+
+        if "error" in reply:
+            raise RuntimeError(f"inference server: {reply['error']}")
+
+        self.version = reply.get("version")
+        return [(label, confidence) for label, confidence in reply["results"]]
+
+
+# ================= SERVER =================
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        import core
+
+        while True:
+            try:
+                request = recv_msg(self.request)
+            except (ConnectionError, OSError):
+                return
+
+            try:
+                model = core.get_model()
+                if not model:
+                    raise RuntimeError("model not loaded")
+                results = core.predict_batch(request["texts"], model)
+                reply = {
+                    "results": [[str(label), float(conf)] for label, conf in results],
+                    "version": core.model_version,
+                }
+            except Exception as e:
+                core.log.exception("inference_error")
+                reply = {"error": str(e)}
+
+            send_msg(self.request, reply)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="K-Defender inference service")
+    parser.add_argument("--socket", default=os.getenv("KDEFENDER_INFERENCE_SOCKET", "/tmp/kdefender-ai.sock"))
+    parser.add_argument("--workers", type=int, default=1, help="pre-forked processes sharing the socket")
+    args = parser.parse_args()
+
+    # this process owns the model: never forward to another server
+    os.environ.pop("KDEFENDER_INFERENCE_SOCKET", None)
+    import core
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = _Server(args.socket, _Handler)
+
+    core.get_model()
+    core.predict_batch(["warmup"], core.get_model())
+
+    children = []
+    for _ in range(args.workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            core.start_model_watcher()
+            server.serve_forever()
+            os._exit(0)
+        children.append(pid)
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    core.start_model_watcher()
+    core.log.info("inference_ready", socket=args.socket, workers=args.workers, version=core.model_version)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, 15)
+            except OSError:
+                pass
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,13 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from io import BytesIO
 
+from klog import get_logger
+from storage import get_store
+import timebuckets
+import alert_bus
+
+log = get_logger("bot")
+
 # =========================
 # Bot API
 # =========================
@@ -35,7 +42,6 @@ if not TOKEN:
 bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
-STATE_FILE = "state.json"
 SIG_FILE = "signatures.json"
 
 _autosave_task = None
@@ -81,6 +87,9 @@ DEFAULT_BOT_SETTINGS = {
     "Flood": True,
 }
 
+# reasons that say nothing about the message text: no verdict buttons (online_train.py)
+NON_CONTENT_REASONS = ("Flood", "INVALID_TOKEN", "LOCKDOWN")
+
 DEFAULT_USER_SETTINGS = {
     "enabled": True,
     "strict": False,
@@ -131,7 +140,8 @@ def load_json(path: str, default: Any) -> Any:
 
 
 def save_state() -> None:
-    _atomic_write_json(STATE_FILE, state)
+    # logs / pending / stats belong to web_api and are never overwritten from here
+    store.save_state(state)
 
 
 def save_signatures() -> None:
@@ -141,7 +151,8 @@ def save_signatures() -> None:
 # =========================
 # State
 # =========================
-state: Dict[str, Any] = load_json(STATE_FILE, {})  # user_id(str) -> data
+store = get_store()  # KDEFENDER_STORAGE: json (state.json) / sqlite
+state: Dict[str, Any] = store.load_state()  # user_id(str) -> data
 signatures: Dict[str, Any] = load_json(SIG_FILE, DEFAULT_SIGNATURES)
 
 # ensure defaults exist in signatures file too
@@ -387,90 +398,137 @@ async def autosave_loop():
     while True:
         await asyncio.sleep(30)
         try:
-            save_state()
+            save_state()  # only users that changed are written
+            # journal -> snapshot, off the event loop
+            await asyncio.to_thread(store.maybe_compact)
         except Exception:
-            pass
+            log.exception("autosave_error")
+
+
+def verdict_kb(user_id: int, bot_id: str, alert: dict) -> InlineKeyboardMarkup | None:
+    # owner's verdict labels the log entry for online training (online_train.py):
+    # only for a content reason, and only while that entry is still in the logs
+    log_time = alert.get("time")
+    reason = alert.get("reason")
+    if not isinstance(log_time, (int, float)) or not isinstance(reason, list):
+        return None
+    if not set(reason) - set(NON_CONTENT_REASONS):
+        return None
+    if not any(e.get("time") == log_time for e in store.get_logs(str(user_id), bot_id, since=log_time)):
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=tr(user_id, "✅ Correct block"), callback_data=f"verdict:block:{bot_id}:{log_time}"),
+        InlineKeyboardButton(text=tr(user_id, "↩️ False positive"), callback_data=f"verdict:allow:{bot_id}:{log_time}"),
+    ]])
+
+
+@dp.callback_query(F.data.startswith("verdict:"))
+async def alert_verdict(call: CallbackQuery):
+    user_id = call.from_user.id
+    try:
+        _, verdict, bot_id, log_time = call.data.split(":", 3)
+        log_time = float(log_time)
+    except ValueError:
+        await call.answer(tr(user_id, "Invalid button"), show_alert=True)
+        return
+
+    found = verdict in ("block", "allow") and store.set_verdict(str(user_id), bot_id, log_time, verdict)
+    if not found:
+        await call.answer(tr(user_id, "This message is no longer in the logs"), show_alert=True)
+        return
+
+    label = "✅ Confirmed block" if verdict == "block" else "↩️ Marked as false positive"
+    try:
+        await call.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=tr(user_id, label), callback_data="noop")
+        ]]))
+    except TelegramBadRequest:
+        pass
+    await call.answer(tr(user_id, "Thanks, noted"))
+
+
+def refresh_state() -> None:
+    # stats / verification written by web_api; our own edits are saved first
+    global state
+    save_state()
+    state = store.load_state()
 
 
 async def alerts_delivery_loop():
+    # web_api rings alert_bus after queueing; bound before the first drain, so nothing is missed
+    wakeup = alert_bus.listen()
     while True:
-        await asyncio.sleep(2.0)
         try:
-            global state
-            state = load_json(STATE_FILE, state)
-
-            for uid_s, u in list(state.items()):
-                bots = (u.get("bots") or {})
-
-                for bot_id, b in list(bots.items()):
-                    if bot_id == DRAFT_BOT_KEY:
-                        continue
-
-                    alerts = b.get("pending", {}).get("alert", [])
-                    info_msgs = b.get("pending", {}).get("info", [])
-                    #print(alerts)
-                    if not alerts and not info_msgs:
-                        continue
-                    
-                    b["pending"]["alert"] = []
-                    b["pending"]["info"] = []
-                    for alert in alerts:
-                        text = alert.get("text", "")
-                        normal = alert.get("normal", "")
-                        score = alert.get("score", 0)
-                        time = alert.get("time", "")
-
-                        reason = alert.get("reason", [])
-                        if isinstance(reason, list):
-                            reason_str = ", ".join(reason)
-                        else:
-                            reason_str = str(reason)
+            events = await asyncio.to_thread(store.pop_pending)
+            if events:
+                refresh_state()
+
+            for uid_s, bot_id, kind, item in events:
+                if bot_id == DRAFT_BOT_KEY:
+                    continue
+                b = (state.get(uid_s, {}).get("bots") or {}).get(bot_id, {})
+
+                if kind == "alert":
+                    alert = item
+                    text = alert.get("text", "")
+                    normal = alert.get("normal", "")
+                    score = alert.get("score", 0)
+                    time = alert.get("time", "")
+                    keyboard = await asyncio.to_thread(verdict_kb, int(uid_s), bot_id, alert)
+
+                    reason = alert.get("reason", [])
+                    if isinstance(reason, list):
+                        reason_str = ", ".join(reason)
+                    else:
+                        reason_str = str(reason)
 
-                        try:
+                    try:
+                        await bot.send_message(
+                            int(uid_s),
+                            tr(
+                                int(uid_s),
+                                f"❌ <b>Blocked message</b>\n\n"
+                                f"🤖 Bot: <code>@{html.escape(b.get('bot_username','unknown'))}</code>\n"
+                                f"Score: <b>{score}</b>\n"
+                                f"Reason: <b>{html.escape(reason_str)}</b>\n\n"
+                                f"Message:\n<code>{html.escape(text)}</code>\n"
+                                f"Normalized:\n<code>{html.escape(normal)}</code>\n\n"
+                                f"Time: {time}"
+
+                            ),
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=keyboard
+                        )
+                        #print("SENT OK")
+
+                    except Exception as e:
+                        log.warning("telegram_error", kind="alert", uid=uid_s, bot_id=bot_id, error=str(e))
+
+                elif kind == "info":
+                    text = item.get("text", "")
+                    try:
+                        if text == "Webhook verified":
+                            global save_verify_msg
+                            await handle_webhook_verified(int(uid_s), bot_id, save_verify_msg)
+                        else:
                             await bot.send_message(
                                 int(uid_s),
                                 tr(
                                     int(uid_s),
-                                    f"❌ <b>Blocked message</b>\n\n"
-                                    f"🤖 Bot: <code>@{html.escape(b.get('bot_username','unknown'))}</code>\n"
-                                    f"Score: <b>{score}</b>\n"
-                                    f"Reason: <b>{html.escape(reason_str)}</b>\n\n"
-                                    f"Message:\n<code>{html.escape(text)}</code>\n"
-                                    f"Normalized:\n<code>{html.escape(normal)}</code>\n\n"
-                                    f"Time: {time}"
-
+                                    f"ℹ️ <b>Info</b>\n\n"
+                                    f"🤖 Bot: <code>@{html.escape(b.get('bot_username','unknown'))}</code>\n\n"
+                                    f"{html.escape(text)}"
                                 ),
                                 parse_mode=ParseMode.HTML
                             )
-                            #print("SENT OK")
-
-                        except Exception as e:
-                            print("TELEGRAM ERROR:", e)
-                    
-                    for info in info_msgs:
-                        text = info.get("text", "")
-                        try:
-                            if text == "Webhook verified":
-                                global save_verify_msg
-                                await handle_webhook_verified(int(uid_s), bot_id, save_verify_msg)
-                            else:
-                                await bot.send_message(
-                                    int(uid_s),
-                                    tr(
-                                        int(uid_s),
-                                        f"ℹ️ <b>Info</b>\n\n"
-                                        f"🤖 Bot: <code>@{html.escape(b.get('bot_username','unknown'))}</code>\n\n"
-                                        f"{html.escape(text)}"
-                                    ),
-                                    parse_mode=ParseMode.HTML
-                                )
-                        except Exception as e:
-                            print("TELEGRAM ERROR:", e)
+                    except Exception as e:
+                        log.warning("telegram_error", kind="info", uid=uid_s, bot_id=bot_id, error=str(e))
 
-            save_state()
+        except Exception:
+            log.exception("alerts_loop_error")
 
-        except Exception as e:
-            print("LOOP ERROR:", e)
+        await wakeup.wait()
+        wakeup.clear()
 
 # =========================
 # Instruction pages
@@ -758,6 +816,7 @@ async def menu_cmd(msg: Message):
 
 @dp.callback_query(F.data == "stats")
 async def stats_panel(call: CallbackQuery):
+    refresh_state()  # web_api counts checks without waking the bot
     user = str(call.from_user.id)
     ensure_user(user)
     bots = real_bots_dict(user)
@@ -802,9 +861,9 @@ async def show_activity_page(call: CallbackQuery, page: int):
     bots = real_bots_dict(user_id)
 
     items = []
-    for b in bots.values():
+    for bot_id, b in bots.items():
         name = b.get("bot_username", "unknown")
-        for entry in (b.get("logs") or []):
+        for entry in store.get_logs(user_id, bot_id):
             items.append((name, entry))
 
     items.sort(
@@ -1081,7 +1140,7 @@ async def show_bot_logs_page(call: CallbackQuery, bot_username: str, page: int):
     if not b:
         return await call.answer("Bot not found", show_alert=True)
 
-    logs = b.get("logs", [])
+    logs = store.get_logs(user_id, bot_id)
 
     # сортировка новые → старые
     logs = sorted(
@@ -1167,66 +1226,18 @@ async def bot_logs_page_handler(call: CallbackQuery):
 
 from datetime import datetime, timezone
 
-STATUS_SAFE_VALUES = {"safe", "ok", "allowed"}
-STATUS_BLOCKED_VALUES = {"blocked"}
-
-def _bucket_ts(ts: float, step_sec: int) -> float:
-    return ts - (ts % step_sec)
-
-def _normalize_status(raw_status: Any) -> str | None:
-    status = str(raw_status or "").strip().lower()
-    if status in STATUS_BLOCKED_VALUES:
-        return "blocked"
-    if status in STATUS_SAFE_VALUES:
-        return "safe"
-    return None
-
-def _iter_valid_logs(logs: list[dict]):
-    for e in logs or []:
-        if not isinstance(e, dict):
-            continue
-        try:
-            t = float(e.get("time", 0) or 0)
-        except (TypeError, ValueError):
-            continue
-        if t <= 0:
-            continue
-        status = _normalize_status(e.get("status"))
-        if not status:
-            continue
-        yield t, status
-
-def _build_timeline_series(logs: list[dict], window_sec: int, step_sec: int, now_ts: float | None = None):
+def _build_timeline_series(user_id: int, bot_id: str, window_sec: int, step_sec: int, now_ts: float | None = None):
+    # pre-aggregated buckets (timebuckets.py), not a scan over the logs
     now_ts = now_ts or datetime.now().timestamp()
-    since_ts = max(now_ts - window_sec, 0)
-    start_bucket = int(_bucket_ts(since_ts, step_sec))
-    end_bucket = int(_bucket_ts(now_ts, step_sec))
-
-    if end_bucket < start_bucket:
-        end_bucket = start_bucket
-
-    buckets = {}
-    cursor = start_bucket
-    while cursor <= end_bucket:
-        buckets[cursor] = {"safe": 0, "blocked": 0}
-        cursor += step_sec
-
-    for t, status in _iter_valid_logs(logs):
-        if t < since_ts or t > now_ts:
-            continue
-        b = int(_bucket_ts(t, step_sec))
-        if b < start_bucket or b > end_bucket:
-            continue
-        buckets[b][status] += 1
+    res = timebuckets.pick_resolution(window_sec, step_sec)
+    rows = store.get_counters(user_id, bot_id, res, since=now_ts - window_sec)
+    starts, safe, blocked = timebuckets.series(rows, window_sec, step_sec, now_ts)
 
-    keys = sorted(buckets.keys())
-    xs = [datetime.fromtimestamp(k) for k in keys]
-    safe = [buckets[k]["safe"] for k in keys]
-    blocked = [buckets[k]["blocked"] for k in keys]
-    return xs, safe, blocked
+    xs = [datetime.fromtimestamp(int(k)) for k in starts]
+    return xs, safe.tolist(), blocked.tolist()
 
-def generate_timeline_chart(user_id: int, title: str, logs: list[dict], window_sec: int, step_sec: int):
-    xs, safe, blocked = _build_timeline_series(logs, window_sec=window_sec, step_sec=step_sec)
+def generate_timeline_chart(user_id: int, title: str, bot_id: str, window_sec: int, step_sec: int):
+    xs, safe, blocked = _build_timeline_series(user_id, bot_id, window_sec=window_sec, step_sec=step_sec)
 
     fig, ax = plt.subplots(figsize=(8, 4))
 
@@ -1259,6 +1270,7 @@ def make_bot_stats_kb(user_id: int, bot_id: str, bot_username: str):
 
 @dp.callback_query(F.data.startswith("botstats_"))
 async def bot_stats_handler(call: CallbackQuery):
+    refresh_state()  # web_api counts checks without waking the bot
     user_id = call.from_user.id
     bot_username = call.data.split("_", 1)[1]
 
@@ -1291,7 +1303,7 @@ async def bot_stats_handler(call: CallbackQuery):
     chart = generate_timeline_chart(
         user_id=user_id,
         title=f"@{bot_username} activity (24h)",
-        logs=b.get("logs", []),
+        bot_id=bot_id,
         window_sec=24 * 3600,
         step_sec=10 * 60,
     )
@@ -1468,6 +1480,7 @@ async def bot_delete_apply(call: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("bot_"))
 async def bot_info(call: CallbackQuery):
+    refresh_state()  # web_api counts checks without waking the bot
     bot_username = "_".join(call.data.split("_")[1:])
     bot_state = None
     bot_id = None
@@ -1774,7 +1787,7 @@ async def protected_wizard_nav(call: CallbackQuery):
 # =========================
 async def main():
     me = await bot.get_me()
-    print(f"K-Defender running as @{me.username} ({me.id})")
+    log.info("bot_started", username=me.username, id=me.id)
 
     global _autosave_task, _alerts_task
     _autosave_task = asyncio.create_task(autosave_loop())
@@ -1794,4 +1807,4 @@ if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("K-Defender stopped by user")
+        log.info("bot_stopped")
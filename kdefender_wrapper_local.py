@@ -145,6 +145,18 @@ def _extract_user_text(update) -> Optional[str]:
     return None
 
 
+def _extract_sender(update) -> tuple[Optional[int], Optional[int]]:
+    """(user_id, chat_id) of whoever sent the update, for per-sender flood limits."""
+    user = getattr(update, "from_user", None)
+    user_id = getattr(user, "id", None)
+
+    # Message -> chat, CallbackQuery -> message.chat
+    chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+    chat_id = getattr(chat, "id", None)
+
+    return user_id, chat_id
+
+
 def _blocked_reply_target(update):
     # aiogram Message
     if hasattr(update, "answer") and not hasattr(update, "data"):
@@ -158,13 +170,15 @@ def _blocked_reply_target(update):
     return None
 
 
-async def _send_and_wait_verdict(text: str, timeout: int = 10) -> bool:
+async def _send_and_wait_verdict(text: str, timeout: int = 10, user_id=None, chat_id=None) -> bool:
     """
     Sends to server:
         {
         "bot_id": <bot_id>,
         "text": <user_text>,
-        "token": <CHAT_TOKEN>
+        "token": <CHAT_TOKEN>,
+        "user_id": <sender id>,   (if known)
+        "chat_id": <chat id>      (if known)
         }
     Waits for K-Defender JSON verdict message.
 
@@ -188,6 +202,10 @@ async def _send_and_wait_verdict(text: str, timeout: int = 10) -> bool:
         "text": text,
         "token": CHAT_TOKEN
     }
+    if user_id is not None:
+        payload["user_id"] = user_id
+    if chat_id is not None:
+        payload["chat_id"] = chat_id
 
     try:
         async with _session.post(
@@ -274,7 +292,8 @@ def kdefender_check(param = None, timeout: int = 10):
             if not text:
                 return await func(*args, **kwargs)
 
-            ok = await _send_and_wait_verdict(text, timeout=timeout)
+            user_id, chat_id = _extract_sender(update)
+            ok = await _send_and_wait_verdict(text, timeout=timeout, user_id=user_id, chat_id=chat_id)
 
             if not ok:
                 target = _blocked_reply_target(update)
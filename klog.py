@@ -0,0 +1,162 @@
+"""
+Structured, non-blocking logging shared by core.py, web-api.py and k-defender.py.
+
+    log = get_logger("core")
+    log.info("model_loaded", version="v3")
+    log.debug("ai_result", text=text, label=label, confidence=confidence)
+
+Records go through a bounded in-memory queue to a background listener that
+writes one JSON object per line (stderr or KDEFENDER_LOG_FILE). A full queue
+drops records instead of blocking the caller. High-volume events can be
+sampled: KDEFENDER_LOG_SAMPLE="ai_result=0.01,telegram_error=0.5".
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+LOG_LEVEL = os.getenv("KDEFENDER_LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("KDEFENDER_LOG_FILE", "")  # empty -> stderr
+LOG_QUEUE_SIZE = int(os.getenv("KDEFENDER_LOG_QUEUE", "10000"))
+MAX_FIELD_LEN = 500  # user payloads are truncated
+
+DEFAULT_SAMPLE = {"ai_result": 0.01}
+
+
+def _parse_sample(raw):
+    rates = dict(DEFAULT_SAMPLE)
+    for part in filter(None, (p.strip() for p in raw.split(","))):
+        event, _, rate = part.partition("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = _parse_sample(os.getenv("KDEFENDER_LOG_SAMPLE", ""))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        # traceback is rendered here, the listener thread only serializes
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        _ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _NonBlockingQueueHandler.dropped += 1
+
+
+_handler = None
+_listener = None
+_listener_pid = None
+_setup_lock = threading.Lock()
+
+
+def _ensure_listener():
+    # the listener thread doesn't survive fork: pool workers start their own
+    global _listener, _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _setup_lock:
+        if _listener_pid == os.getpid():
+            return
+
+        if LOG_FILE:
+            target = logging.FileHandler(LOG_FILE, encoding="utf-8")
+        else:
+            target = logging.StreamHandler()
+        target.setFormatter(JsonFormatter())
+
+        _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(_handler.queue, target)
+        _listener.start()
+        _listener_pid = os.getpid()
+
+
+def _setup():
+    global _handler
+    with _setup_lock:
+        if _handler is not None:
+            return
+        _handler = _NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        root = logging.getLogger("kdefender")
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(_handler)
+        root.propagate = False
+        atexit.register(flush)
+
+
+def flush():
+    """Stops the listener after draining the queue (runs at exit)."""
+    global _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _listener_pid = None
+
+
+def dropped_count():
+    return _NonBlockingQueueHandler.dropped
+
+
+class StructLogger:
+    def __init__(self, name):
+        self._log = logging.getLogger("kdefender." + name)
+
+    def _emit(self, level, event, fields, exc_info=False):
+        if not self._log.isEnabledFor(level):
+            return
+        rate = SAMPLE_RATES.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        for k, v in fields.items():
+            if isinstance(v, str) and len(v) > MAX_FIELD_LEN:
+                fields[k] = v[:MAX_FIELD_LEN] + "..."
+        self._log.log(level, event, extra={"fields": fields}, exc_info=exc_info)
+
+    def debug(self, event, **fields):
+        self._emit(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._emit(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._emit(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._emit(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        self._emit(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(name):
+    _setup()
+    return StructLogger(name)
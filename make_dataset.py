@@ -1,9 +1,13 @@
+import argparse
+import hashlib
 import json
+import os
 import random
 import re
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
 
-random.seed()
+from dataset_io import ShardWriter, DATASET_DIR
 
 # ================= CONFIG =================
 
@@ -28,32 +32,32 @@ RANDOM_WORDS = [
 
 # ================= HELPERS =================
 
-def random_noise():
-    if random.random() < 0.3:
-        return f" #{random.randint(1,999)}"
-    if random.random() < 0.3:
-        return f" {random.choice(RANDOM_WORDS)}"
+def random_noise(rng=random):
+    if rng.random() < 0.3:
+        return f" #{rng.randint(1,999)}"
+    if rng.random() < 0.3:
+        return f" {rng.choice(RANDOM_WORDS)}"
     return ""
 
-def random_typo(s):
+def random_typo(s, rng=random):
     if len(s) < 3:
         return s
-    i = random.randint(0, len(s)-2)
+    i = rng.randint(0, len(s)-2)
     return s[:i] + s[i+1] + s[i] + s[i+2:]
 
-def safe_samples(n=15000):
+def safe_samples(n=15000, rng=random):
     data = []
     for _ in range(n):
-        base = random.choice(SAFE_COMMANDS + SAFE_CHAT)
-        if random.random() < 0.3:
-            base = random_typo(base)
-        base += random_noise()
+        base = rng.choice(SAFE_COMMANDS + SAFE_CHAT)
+        if rng.random() < 0.3:
+            base = random_typo(base, rng)
+        base += random_noise(rng)
         data.append((base, "Safe"))
     return data
 
 # ================= INJECTION BUILDERS =================
 
-def sqli_payload():
+def sqli_payload(rng=random):
     templates = [
         "' OR 1=1 --",
         "' UNION SELECT password FROM users --",
@@ -62,18 +66,18 @@ def sqli_payload():
         "1 OR 1=1",
         "' AND SLEEP(5) --"
     ]
-    return random.choice(templates)
+    return rng.choice(templates)
 
-def xss_payload():
+def xss_payload(rng=random):
     templates = [
         "<script>alert(1)</script>",
         "<img src=x onerror=alert(1)>",
         "<svg/onload=alert(1)>",
         "<iframe src=javascript:alert(1)>"
     ]
-    return random.choice(templates)
+    return rng.choice(templates)
 
-def cmd_payload():
+def cmd_payload(rng=random):
     templates = [
         "&& whoami",
         "; rm -rf /",
@@ -81,24 +85,24 @@ def cmd_payload():
         "|| ls -la",
         "$(cat /etc/passwd)"
     ]
-    return random.choice(templates)
+    return rng.choice(templates)
 
-def markdown_payload():
+def markdown_payload(rng=random):
     templates = [
         "`rm -rf /`",
         "```bash\nls\n```",
         "[click](javascript:alert(1))"
     ]
-    return random.choice(templates)
+    return rng.choice(templates)
 
-def entity_payload():
+def entity_payload(rng=random):
     templates = [
         "token=abc123",
         "chat_id=999999",
         "file://etc/passwd",
         "data:text/html;base64,PHNjcmlwdD4="
     ]
-    return random.choice(templates)
+    return rng.choice(templates)
 
 INJ_BUILDERS = {
     "SQLi": sqli_payload,
@@ -108,7 +112,7 @@ INJ_BUILDERS = {
     "Entity_manipulation": entity_payload
 }
 
-def wrap_payload(p):
+def wrap_payload(p, rng=random):
     wrappers = [
         f"q={p}",
         f"search={p}",
@@ -119,44 +123,92 @@ def wrap_payload(p):
         f"/login {p}",
         f"/echo {p}"
     ]
-    return random.choice(wrappers)
+    return rng.choice(wrappers)
 
-def malicious_samples(n_per_class=4000):
+def malicious_samples(n_per_class=4000, rng=random):
     data = []
     for label, builder in INJ_BUILDERS.items():
         for _ in range(n_per_class):
-            payload = builder()
-            payload = wrap_payload(payload)
+            payload = builder(rng)
+            payload = wrap_payload(payload, rng)
 
-            if random.random() < 0.2:
+            if rng.random() < 0.2:
                 payload = urllib.parse.quote(payload)
 
-            if random.random() < 0.2:
-                payload = random_typo(payload)
+            if rng.random() < 0.2:
+                payload = random_typo(payload, rng)
 
             data.append((payload, label))
     return data
 
 # ================= MAIN =================
 
-def main():
-    data = []
-
-    data += safe_samples(20000)
-    data += malicious_samples(5000)
-
-    random.shuffle(data)
+def generate_task(task):
+    """
+    One unit of work: a mixed, shuffled slice of the dataset.
+    Seeded per task, so the output doesn't depend on worker count or scheduling.
+    """
+    rng = random.Random(task["seed"])
 
-    texts = [t for t, y in data]
-    labels = [y for t, y in data]
+    data = safe_samples(task["safe"], rng) + malicious_samples(task["per_class"], rng)
+    rng.shuffle(data)
 
-    print("Total samples:", len(texts))
+    if task["dedup"]:
+        data = list(dict.fromkeys(data))
+    return data
 
-    with open("dataset_py.py", "w", encoding="utf-8") as f:
-        f.write("texts = " + repr(texts) + "\n\n")
-        f.write("labels = " + repr(labels) + "\n")
+def make_tasks(n_safe, n_per_class, task_size, seed, dedup):
+    total = n_safe + n_per_class * len(INJ_BUILDERS)
+    n_tasks = max(1, -(-total // task_size))
+
+    def split(n, i):
+        return n // n_tasks + (1 if i < n % n_tasks else 0)
+
+    return [
+        {
+            "seed": f"{seed}:{i}",
+            "safe": split(n_safe, i),
+            "per_class": split(n_per_class, i),
+            "dedup": dedup,
+        }
+        for i in range(n_tasks)
+    ]
 
-    print("Saved dataset_py.py")
+def main():
+    parser = argparse.ArgumentParser(description="Generate the K-Defender training dataset")
+    parser.add_argument("--safe", type=int, default=20000, help="safe samples")
+    parser.add_argument("--per-class", type=int, default=5000, help="samples per injection class")
+    parser.add_argument("--seed", default="42", help="base seed, the same seed gives the same dataset")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--task-size", type=int, default=50000, help="samples per generation task")
+    parser.add_argument("--no-dedup", action="store_true", help="keep identical samples")
+    parser.add_argument("--out", default=DATASET_DIR)
+    args = parser.parse_args()
+
+    dedup = not args.no_dedup
+    tasks = make_tasks(args.safe, args.per_class, args.task_size, args.seed, dedup)
+
+    seen = set()
+    generated = 0
+
+    with ShardWriter(args.out) as writer, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        # map() keeps task order -> deterministic output
+        for data in pool.map(generate_task, tasks):
+            generated += len(data)
+            for text, label in data:
+                if dedup:
+                    key = hashlib.blake2b(f"{label}\0{text}".encode("utf-8"), digest_size=8).digest()
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                writer.write(text, label)
+
+    total = sum(writer.labels.values())
+    print("Total samples:", total)
+    if dedup:
+        print("Duplicates removed:", args.safe + args.per_class * len(INJ_BUILDERS) - total)
+    print("Per label:", dict(writer.labels))
+    print("Saved " + args.out + "/ (" + str(len(writer.shards)) + " shards)")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
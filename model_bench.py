@@ -0,0 +1,139 @@
+"""
+Inference benchmark of a saved model artifact (.npz native or .pkl pipeline).
+
+Runs in a fresh interpreter, so load time and resident memory aren't skewed
+by whatever the caller already has in memory:
+
+    python model_bench.py kdefender_ai.npz texts.json --batch-size 64   -> JSON on stdout
+
+train_model.py calls measure() for the performance section of
+training_report.txt and check_gate() before it replaces the saved model.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+GATE_SLACK_MS = 0.05  # sub-0.05ms differences are timer noise, not regressions
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource  # no /proc: peak RSS is the best we have
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_artifact(path):
+    if path.endswith(".npz"):
+        from native_model import NativeScorer
+        return NativeScorer(path)
+    import joblib
+    return joblib.load(path, mmap_mode="r")  # as core.py loads it
+
+
+def _percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return float(np.percentile(ms, 50)), float(np.percentile(ms, 99))
+
+
+def run(path, texts, batch_size=64):
+    rss_before = _rss_bytes()
+    started = time.perf_counter()
+    model = load_artifact(path)
+    load_ms = (time.perf_counter() - started) * 1000
+    rss_after = _rss_bytes()
+
+    model.predict_proba(texts[:1])
+
+    single = []
+    for t in texts:
+        started = time.perf_counter()
+        model.predict_proba([t])
+        single.append(time.perf_counter() - started)
+
+    batched = []
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i + batch_size]
+        started = time.perf_counter()
+        model.predict_proba(batch)
+        batched.append(time.perf_counter() - started)
+
+    single_p50, single_p99 = _percentiles(single)
+    batch_p50, batch_p99 = _percentiles(batched)
+    return {
+        "file_kb": os.path.getsize(path) / 1024,
+        "load_ms": load_ms,
+        "rss_kb": max(rss_after - rss_before, 0) / 1024,
+        "single_p50_ms": single_p50,
+        "single_p99_ms": single_p99,
+        "batch_p50_ms": batch_p50,
+        "batch_p99_ms": batch_p99,
+        "batch_size": batch_size,
+    }
+
+
+def measure(path, texts, batch_size=64):
+    """run() in a child interpreter."""
+    with tempfile.NamedTemporaryFile("w", suffix=".json", encoding="utf-8", delete=False) as f:
+        json.dump(list(texts), f, ensure_ascii=False)
+    try:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), os.path.abspath(path), f.name,
+             "--batch-size", str(batch_size)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+    finally:
+        os.remove(f.name)
+    return json.loads(out)
+
+
+def check_gate(new, current, max_ratio=None, max_p99_ms=None):
+    """Reasons the new model is too slow ([] = passes)."""
+    failures = []
+    if max_p99_ms is not None and new["single_p99_ms"] > max_p99_ms:
+        failures.append("single p99 %.3f ms > %.3f ms" % (new["single_p99_ms"], max_p99_ms))
+
+    if current is not None and max_ratio is not None:
+        for key in ("single_p99_ms", "batch_p99_ms"):
+            bound = max(current[key] * max_ratio, current[key] + GATE_SLACK_MS)
+            if new[key] > bound:
+                failures.append("%s %.3f ms > %.3f ms (current %.3f ms x %.2f)" % (
+                    key, new[key], bound, current[key], max_ratio
+                ))
+    return failures
+
+
+def format_bench(rows):
+    lines = ["%-16s %9s %9s %9s %10s %10s %10s %10s" % (
+        "artifact", "file KB", "load ms", "RSS KB", "1x p50 ms", "1x p99 ms", "Nx p50 ms", "Nx p99 ms"
+    )]
+    for name, r in rows.items():
+        lines.append("%-16s %9.0f %9.1f %9.0f %10.3f %10.3f %10.3f %10.3f" % (
+            name, r["file_kb"], r["load_ms"], r["rss_kb"],
+            r["single_p50_ms"], r["single_p99_ms"], r["batch_p50_ms"], r["batch_p99_ms"]
+        ))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a K-Defender model artifact")
+    parser.add_argument("path", help=".npz or .pkl")
+    parser.add_argument("texts", help="JSON list of texts to score")
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    with open(args.texts, "r", encoding="utf-8") as f:
+        texts = json.load(f)
+    print(json.dumps(run(args.path, texts, args.batch_size)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Versioned model directory with a manifest.
+
+models/
+  manifest.json      {"active": "...", "previous": "...", "versions": {version: {...}}}
+  20261019-153000/
+    kdefender_ai.npz
+    kdefender_ai.pkl
+
+publish() copies the files into a new version directory first and only then
+switches manifest.json with os.replace, so readers never see a half-written model.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+MODEL_DIR = os.getenv("KDEFENDER_MODEL_DIR", "models")
+MANIFEST_FILE = "manifest.json"
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(model_dir=MODEL_DIR):
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, model_dir=MODEL_DIR):
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def publish(files, version=None, model_dir=MODEL_DIR, activate=True):
+    """Copies model files into models/<version>/ and (optionally) makes it active."""
+    version = version or time.strftime("%Y%m%d-%H%M%S")
+    target = os.path.join(model_dir, version)
+    if os.path.exists(target):
+        raise ValueError(f"model version {version} already exists")
+
+    tmp = target + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for src in files:
+        shutil.copy2(src, os.path.join(tmp, os.path.basename(src)))
+    os.replace(tmp, target)
+
+    manifest = read_manifest(model_dir) or {"active": None, "previous": None, "versions": {}}
+    manifest["versions"][version] = {
+        "files": {os.path.basename(src): _sha256(os.path.join(target, os.path.basename(src)))
+                  for src in files},
+        "created": time.time(),
+    }
+    if activate:
+        manifest["previous"], manifest["active"] = manifest["active"], version
+    write_manifest(manifest, model_dir)
+    return version
+
+
+def activate(version, model_dir=MODEL_DIR):
+    manifest = read_manifest(model_dir)
+    if not manifest or version not in manifest["versions"]:
+        raise ValueError(f"unknown model version {version}")
+    if manifest["active"] != version:
+        manifest["previous"], manifest["active"] = manifest["active"], version
+        write_manifest(manifest, model_dir)
+
+
+def rollback(model_dir=MODEL_DIR):
+    """Makes the previous version active again."""
+    manifest = read_manifest(model_dir)
+    if not manifest or not manifest.get("previous"):
+        raise ValueError("no previous model version")
+    activate(manifest["previous"], model_dir)
+
+
+def load_version(version, model_dir=MODEL_DIR, mmap_mode=None):
+    """Loads a published version (native .npz preferred), checking file hashes."""
+    manifest = read_manifest(model_dir)
+    if not manifest or version not in manifest["versions"]:
+        raise ValueError(f"unknown model version {version}")
+
+    files = manifest["versions"][version]["files"]
+    native = [name for name in files if name.endswith(".npz")]
+    name = native[0] if native else next(name for name in files if name.endswith(".pkl"))
+    path = os.path.join(model_dir, version, name)
+
+    if _sha256(path) != files[name]:
+        raise ValueError(f"model version {version}: {name} checksum mismatch")
+
+    if name.endswith(".npz"):
+        from native_model import NativeScorer
+        return NativeScorer(path, mmap_mode=mmap_mode)
+
+    import joblib
+    return joblib.load(path, mmap_mode=mmap_mode)
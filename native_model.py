@@ -0,0 +1,336 @@
+"""
+Compact NumPy-only scorer for the FeatureUnion(TF-IDF) + LogisticRegression model.
+
+export_native_model(pipeline, path) -> writes kdefender_ai.npz (train_model.py)
+NativeScorer(path)                  -> drop-in for the pipeline: predict_proba / classes_ (core.py)
+
+The artifact is a plain .npz (no pickle): vocabularies as utf-8 blobs + offsets,
+IDF weights, coefficient matrix, intercepts, classes and vectorizer params as JSON.
+np.savez stores the members uncompressed, so NativeScorer(path, mmap_mode="r")
+maps the arrays straight from the file: processes share those pages instead of
+each holding a copy. The vocabularies are not shared: each process decodes them
+into a dict (~7 MB and ~20 ms for the ~48k terms of kdefender_ai.npz), because a
+dict lookup per n-gram is several times faster than searching an on-disk table.
+Workers forked after core.warm_up() inherit the parent's dict copy-on-write.
+
+Hashed models (HashingVectorizer -> TfidfTransformer branches) have no vocabulary;
+scoring them needs sklearn's murmurhash3_32, everything else stays NumPy.
+Coefficients can be stored as float16 or int8 (per-class scale); the IDF
+weights are then stored as float16 too (float64 only for an exact float64 model).
+"""
+import json
+import mmap
+import re
+import struct
+import zipfile
+from collections import Counter
+
+import numpy as np
+
+_WHITE_SPACES = re.compile(r"\s\s+")
+
+SUPPORTED_ANALYZERS = ("char", "word")
+COEF_DTYPES = ("float64", "float16", "int8")
+
+
+# ================= ANALYZERS (same as sklearn) =================
+
+def _char_ngrams(text, min_n, max_n):
+    text = _WHITE_SPACES.sub(" ", text)
+    text_len = len(text)
+    ngrams = []
+    for n in range(min_n, min(max_n + 1, text_len + 1)):
+        ngrams.extend(text[i:i + n] for i in range(text_len - n + 1))
+    return ngrams
+
+
+def _word_ngrams(tokens, min_n, max_n):
+    if max_n == 1:
+        return tokens
+
+    n_tokens = len(tokens)
+    ngrams = []
+    if min_n == 1:
+        ngrams = list(tokens)
+        min_n += 1
+    for n in range(min_n, min(max_n + 1, n_tokens + 1)):
+        ngrams.extend(" ".join(tokens[i:i + n]) for i in range(n_tokens - n + 1))
+    return ngrams
+
+
+# ================= EXPORT =================
+
+def _split_branch(branch):
+    """TfidfVectorizer or Pipeline(HashingVectorizer, TfidfTransformer) -> (vectorizer, tfidf)."""
+    steps = getattr(branch, "steps", None)
+    if steps is None:
+        return branch, branch
+    if len(steps) != 2:
+        raise ValueError("hashed branch must be Pipeline([hashing, tfidf])")
+    return steps[0][1], steps[1][1]
+
+
+def _check_vectorizer(name, branch):
+    vec, tfidf = _split_branch(branch)
+    params = vec.get_params()
+    tfidf_params = tfidf.get_params()
+    hashed = hasattr(vec, "n_features")
+
+    problems = []
+    if params["analyzer"] not in SUPPORTED_ANALYZERS:
+        problems.append(f"analyzer={params['analyzer']!r}")
+    for key in ("preprocessor", "tokenizer", "stop_words", "strip_accents"):
+        if params[key] is not None:
+            problems.append(f"{key}={params[key]!r}")
+    if params["binary"] or not tfidf_params["use_idf"]:
+        problems.append("binary/use_idf")
+    if tfidf_params["norm"] not in ("l2", None):
+        problems.append(f"norm={tfidf_params['norm']!r}")
+    if hashed and (params["norm"] is not None or params["alternate_sign"]):
+        problems.append("hashing vectorizer needs norm=None, alternate_sign=False")
+    if problems:
+        raise ValueError(f"{name}: unsupported vectorizer settings: " + ", ".join(problems))
+
+    return {
+        "analyzer": params["analyzer"],
+        "ngram_range": list(params["ngram_range"]),
+        "lowercase": params["lowercase"],
+        "sublinear_tf": tfidf_params["sublinear_tf"],
+        "norm": tfidf_params["norm"],
+        "token_pattern": params["token_pattern"],
+        "n_features": params["n_features"] if hashed else None,
+    }
+
+
+def _proba_mode(clf):
+    if len(clf.classes_) == 2:
+        return "binary"
+    # SGDClassifier(loss="log_loss") is one-vs-rest
+    if getattr(clf, "loss", None) == "log_loss":
+        return "ovr"
+    if getattr(clf, "multi_class", "auto") == "ovr" or clf.solver == "liblinear":
+        return "ovr"
+    return "multinomial"
+
+
+def quantize_coef(coef, dtype="float64"):
+    """-> (stored coef, per-class scale). Scores use coef * scale[:, None]."""
+    coef = np.asarray(coef, dtype=np.float64)
+    scale = np.ones(coef.shape[0])
+
+    if dtype == "float16":
+        return coef.astype(np.float16), scale
+
+    if dtype == "int8":
+        scale = np.abs(coef).max(axis=1) / 127
+        scale[scale == 0] = 1.0
+        return np.round(coef / scale[:, None]).astype(np.int8), scale
+
+    if dtype != "float64":
+        raise ValueError(f"coef dtype must be one of {COEF_DTYPES}")
+    return coef, scale
+
+
+def export_native_model(pipeline, path, coef_dtype="float64"):
+    """Writes the fitted pipeline as a compact .npz artifact."""
+    features = pipeline.named_steps["features"]
+    clf = pipeline.named_steps["clf"]
+
+    arrays = {}
+    vectorizers = []
+
+    for name, branch in features.transformer_list:
+        params = _check_vectorizer(name, branch)
+        vec, tfidf = _split_branch(branch)
+
+        if params["n_features"] is None:
+            terms = [None] * len(vec.vocabulary_)
+            for term, idx in vec.vocabulary_.items():
+                terms[idx] = term
+
+            offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(t) for t in terms])
+
+            arrays[f"{name}_terms"] = np.frombuffer("".join(terms).encode("utf-8"), dtype=np.uint8)
+            arrays[f"{name}_offsets"] = offsets
+
+        idf_dtype = np.float64 if coef_dtype == "float64" else np.float16
+        arrays[f"{name}_idf"] = np.asarray(tfidf.idf_, dtype=idf_dtype)
+        vectorizers.append({"name": name, **params})
+
+    meta = {
+        "vectorizers": vectorizers,
+        "proba": _proba_mode(clf),
+    }
+
+    arrays["coef"], arrays["coef_scale"] = quantize_coef(clf.coef_, coef_dtype)
+    arrays["intercept"] = np.asarray(clf.intercept_, dtype=np.float64)
+    arrays["classes"] = np.asarray([str(c) for c in clf.classes_])
+    arrays["meta"] = np.asarray(json.dumps(meta))
+
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+# ================= SCORER =================
+
+def _mmap_members(path):
+    """
+    {member: read-only array backed by one shared mmap of the file}, or None
+    when a member is compressed (np.savez_compressed): load those normally.
+    """
+    members = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED or not info.filename.endswith(".npy"):
+                return None
+            # local file header: 30 bytes, then the name and the extra field
+            name_len, extra_len = struct.unpack("<HH", buf[info.header_offset + 26:info.header_offset + 30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran, dtype = read_header(f)
+            if dtype.hasobject:
+                return None
+            count = int(np.prod(shape))
+            arr = np.frombuffer(buf, dtype=dtype, count=count, offset=f.tell())
+            members[info.filename[:-4]] = arr.reshape(shape, order="F" if fortran else "C")
+    return members
+
+
+class NativeScorer:
+    """
+    Same probabilities as the sklearn pipeline, without sklearn.
+
+    mmap_mode="r" maps the arrays from the file instead of reading them
+    (core.py's KDEFENDER_MODEL_MMAP, as for the joblib model).
+    """
+
+    def __init__(self, path, mmap_mode=None):
+        z = _mmap_members(path) if mmap_mode else None
+        if z is None:
+            with np.load(path, allow_pickle=False) as npz:
+                z = {key: npz[key] for key in npz.files}
+
+        meta = json.loads(str(z["meta"]))
+        self.coef = z["coef"]
+        self.coef_scale = z["coef_scale"] if "coef_scale" in z else np.ones(self.coef.shape[0])
+        self.intercept = z["intercept"]
+        self.classes_ = z["classes"]
+        self.proba = meta["proba"]
+
+        self.vectorizers = []
+        offset = 0
+        for params in meta["vectorizers"]:
+            name = params["name"]
+            vocab = None
+            if params.get("n_features") is None:
+                blob = z[f"{name}_terms"].tobytes().decode("utf-8")
+                bounds = z[f"{name}_offsets"].tolist()
+                vocab = {blob[bounds[i]:bounds[i + 1]]: i for i in range(len(bounds) - 1)}
+            idf = z[f"{name}_idf"]
+
+            self.vectorizers.append({
+                **params,
+                "vocab": vocab,
+                "idf": idf,
+                "offset": offset,
+                "token_re": re.compile(params["token_pattern"]),
+            })
+            offset += len(idf)
+
+    def _analyze(self, vec, text):
+        if vec["lowercase"]:
+            text = text.lower()
+        min_n, max_n = vec["ngram_range"]
+        if vec["analyzer"] == "char":
+            return _char_ngrams(text, min_n, max_n)
+        return _word_ngrams(vec["token_re"].findall(text), min_n, max_n)
+
+    def _lookup(self, vec, terms):
+        """Term counts -> (feature indices, counts)."""
+        vocab = vec["vocab"]
+        idx, counts = [], []
+
+        if vocab is not None:
+            for term, count in Counter(terms).items():
+                j = vocab.get(term)
+                if j is not None:
+                    idx.append(j)
+                    counts.append(count)
+            return idx, counts
+
+        # hashed: same bucket as sklearn's FeatureHasher (alternate_sign=False)
+        from sklearn.utils import murmurhash3_32
+
+        n_features = vec["n_features"]
+        buckets = Counter()
+        for term, count in Counter(terms).items():
+            h = murmurhash3_32(term, seed=0)
+            if h == -2147483648:
+                buckets[(2147483647 - (n_features - 1)) % n_features] += count
+            else:
+                buckets[abs(h) % n_features] += count
+        return list(buckets), list(buckets.values())
+
+    def _features(self, text):
+        """Sparse tf-idf row as (feature indices, values)."""
+        all_idx, all_vals = [], []
+
+        for vec in self.vectorizers:
+            idx, counts = self._lookup(vec, self._analyze(vec, text))
+            if not idx:
+                continue
+
+            idx = np.asarray(idx, dtype=np.int64)
+            tf = np.asarray(counts, dtype=np.float64)
+            if vec["sublinear_tf"]:
+                tf = np.log(tf) + 1
+            vals = tf * vec["idf"][idx]
+            if vec["norm"] == "l2":
+                norm = np.sqrt(np.dot(vals, vals))
+                if norm > 0:
+                    vals /= norm
+
+            all_idx.append(idx + vec["offset"])
+            all_vals.append(vals)
+
+        if not all_idx:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        return np.concatenate(all_idx), np.concatenate(all_vals)
+
+    def decision_function(self, texts):
+        scores = np.empty((len(texts), self.coef.shape[0]))
+        for row, text in enumerate(texts):
+            idx, vals = self._features(text)
+            scores[row] = (self.coef[:, idx] @ vals) * self.coef_scale + self.intercept
+        return scores
+
+    def memory_bytes(self):
+        """Approximate resident size of the model data."""
+        import sys
+
+        size = self.coef.nbytes + self.intercept.nbytes
+        for vec in self.vectorizers:
+            size += vec["idf"].nbytes
+            if vec["vocab"] is not None:
+                size += sys.getsizeof(vec["vocab"])
+                size += sum(sys.getsizeof(t) for t in vec["vocab"])
+        return size
+
+    def predict_proba(self, texts):
+        scores = self.decision_function(texts)
+
+        if self.proba == "binary":
+            p = 1 / (1 + np.exp(-scores[:, 0]))
+            return np.column_stack([1 - p, p])
+
+        if self.proba == "ovr":
+            p = 1 / (1 + np.exp(-scores))
+            return p / p.sum(axis=1, keepdims=True)
+
+        scores -= scores.max(axis=1, keepdims=True)
+        np.exp(scores, out=scores)
+        return scores / scores.sum(axis=1, keepdims=True)
@@ -1,10 +1,15 @@
+import os
 import re
 import html
+import time
+import threading
 import base64
 import binascii
 import codecs
+import quopri
+import zlib
 import unicodedata
-from collections import deque
+from collections import Counter, deque
 from urllib.parse import unquote_plus, unquote
 
 _ZERO_WIDTH_RE = re.compile(r"[\u200B-\u200F\u202A-\u202E\u2060-\u206F\uFEFF]")
@@ -40,6 +45,36 @@ def _safe_ratio(s: str) -> float:
     return printable / max(1, len(s))
 
 
+_SIGNAL_KEYWORDS = (
+    "union select",
+    "select",
+    "insert",
+    "drop",
+    "delete",
+    "<script",
+    "javascript:",
+    "alert(",
+    "onerror",
+    "onload",
+)
+# Lookahead makes matches zero-width, so overlapping keywords
+# ("union select" / "select") are all found in one scan.
+# Keywords must not be prefixes of each other.
+_SIGNAL_KEYWORDS_RE = re.compile(
+    "(?=(" + "|".join(re.escape(k) for k in _SIGNAL_KEYWORDS) + "))"
+)
+
+_WEIRD_CHARS = frozenset("¦§¤¨©±÷×¼½¾¿")
+
+
+def _classify_char(ch: str) -> tuple[bool, bool, bool]:
+    return ch.isalpha(), not ch.isprintable(), ch in _WEIRD_CHARS
+
+
+# (буква, непечатаемый, "странный") для первых 0x800 кодпоинтов
+_CHAR_CLASSES = {chr(i): _classify_char(chr(i)) for i in range(0x800)}
+
+
 def _signal_score(s: str) -> float:
 
     if not s:
@@ -49,42 +84,35 @@ def _signal_score(s: str) -> float:
 
     lowered = s.lower()
 
-    keywords = [
-        "union select",
-        "select",
-        "insert",
-        "drop",
-        "delete",
-        "<script",
-        "javascript:",
-        "alert(",
-        "onerror",
-        "onload"
-    ]
+    found = {m.group(1) for m in _SIGNAL_KEYWORDS_RE.finditer(lowered)}
+    score += 8 * len(found)
 
-    for k in keywords:
-        if k in lowered:
-            score += 8
+    counts = Counter(s)
 
-    if "<" in s and ">" in s:
+    if "<" in counts and ">" in counts:
         score += 2
 
-    letters = sum(c.isalpha() for c in s)
-    score += letters * 0.05
+    letters = non_print = weird = 0
+    for ch, n in counts.items():
+        cls = _CHAR_CLASSES.get(ch)
+        if cls is None:
+            cls = _classify_char(ch)
+        is_alpha, is_non_print, is_weird = cls
+        if is_alpha:
+            letters += n
+        if is_non_print:
+            non_print += n
+        if is_weird:
+            weird += n
 
-    non_print = sum(not c.isprintable() for c in s)
+    score += letters * 0.05
     score -= non_print * 2
-
-    weird = sum(c in "¦§¤¨©±÷×¼½¾¿" for c in s)
     score -= weird * 3
 
-    #if re.fullmatch(r"[A-Za-z0-9+/=_-]{30,}", s):
-    #   score -= 3
-
-    if "%" in s:
+    if "%" in counts:
         score -= 1
 
-    if "\\" in s:
+    if "\\" in counts:
         score -= 1
 
     return score
@@ -386,29 +414,256 @@ def _decode_rot13(s: str) -> list[str]:
     return [dec]
 
 
-def _transforms(s: str, max_out: int) -> list[tuple[str, str]]:
+_QP_RE = re.compile(r"=[0-9A-F]{2}|=\r?\n")
+_PUNYCODE_RE = re.compile(r"xn--[a-z0-9-]+", re.IGNORECASE)
+_JWT_RE = re.compile(r"^eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*$")
+# base64 от заголовков gzip (1f 8b) и zlib (78 01/5e/9c/da)
+_COMPRESSED_B64_PREFIXES = ("H4sI", "eA", "eF", "eJ", "eN")
+
+
+def _b64_to_bytes(t: str) -> bytes | None:
+    normalized = t.replace("-", "+").replace("_", "/")
+    padded = normalized + "=" * ((4 - len(normalized) % 4) % 4)
+    try:
+        return base64.b64decode(padded)
+    except Exception:
+        return None
+
+
+def _decode_compressed_blob(s: str, max_out: int) -> list[str]:
+    t = s.strip()
+    if not _looks_base64(t):
+        return []
+
+    raw = _b64_to_bytes(t)
+    if not raw:
+        return []
+
+    try:
+        # wbits=47: автоопределение gzip/zlib; max_length защищает от zip-бомб
+        raw = zlib.decompressobj(wbits=47).decompress(raw, max_out)
+    except Exception:
+        return []
+
+    if not raw:
+        return []
+
+    dec = raw.decode("utf-8", errors="replace")
+    return [dec] if _looks_textual(dec) else []
+
+
+def _decode_jwt(s: str, max_out: int) -> list[str]:
+    t = s.strip()
+    if not _JWT_RE.fullmatch(t):
+        return []
+
+    parts = []
+    for segment in t.split(".")[:2]:
+        raw = _b64_to_bytes(segment)
+        if not raw or len(raw) > max_out:
+            return []
+        parts.append(raw.decode("utf-8", errors="replace"))
+
+    dec = " ".join(parts)
+    return [dec] if _looks_textual(dec) else []
+
+
+def _decode_punycode(s: str) -> list[str]:
+    def repl(m: re.Match) -> str:
+        try:
+            return codecs.decode(m.group(0)[4:].encode(), "punycode")
+        except Exception:
+            return m.group(0)
+
+    dec = _PUNYCODE_RE.sub(repl, s)
+    return [dec] if dec != s else []
+
+
+def _decode_quoted_printable(s: str) -> list[str]:
+    try:
+        dec = quopri.decodestring(s.encode("utf-8")).decode("utf-8", errors="replace")
+    except Exception:
+        return []
+    return [dec] if dec != s and _looks_textual(dec) else []
+
+
+# ================= TRANSFORM PROFILING =================
+
+PROFILE_TRANSFORMS = os.getenv("KDEFENDER_PROFILE_TRANSFORMS", "") == "1"
+
+_transform_stats: dict[str, dict] = {}
+_transform_stats_lock = threading.Lock()
+
+
+def enable_transform_profiling(enabled: bool = True) -> None:
+    global PROFILE_TRANSFORMS
+    PROFILE_TRANSFORMS = enabled
+
+
+def get_transform_stats(reset: bool = False) -> dict[str, dict]:
     """
-    Возвращает список (название_преобразования, результат).
+    Статистика по преобразованиям:
+    {name: {"tried": ..., "succeeded": ..., "outputs": ..., "time": ...}}
     """
-    results: list[tuple[str, str]] = []
-    results.extend(("base64", x) for x in _decode_base64(s, max_out))
+    global _transform_stats
+    with _transform_stats_lock:
+        stats = {name: dict(st) for name, st in _transform_stats.items()}
+        if reset:
+            _transform_stats = {}
+    return stats
+
+
+def _record_transform(name: str, outputs: int, elapsed: float) -> None:
+    with _transform_stats_lock:
+        st = _transform_stats.get(name)
+        if st is None:
+            st = _transform_stats[name] = {"tried": 0, "succeeded": 0, "outputs": 0, "time": 0.0}
+        st["tried"] += 1
+        st["succeeded"] += 1 if outputs else 0
+        st["outputs"] += outputs
+        st["time"] += elapsed
+
+
+def _run_transform(decoder: dict, s: str, max_out: int) -> list[tuple[str, str]]:
+    name = decoder["name"]
+    if not PROFILE_TRANSFORMS:
+        out = decoder["fn"](s, max_out)
+    else:
+        started = time.perf_counter()
+        out = decoder["fn"](s, max_out)
+        _record_transform(name, len(out), time.perf_counter() - started)
+
+    # счётчики нужны только для бюджета: без него их не трогаем совсем
+    if DECODE_BUDGET > 0:
+        with _transform_stats_lock:
+            decoder["tried"] += 1
+            if out:
+                decoder["succeeded"] += 1
+
+    return [(name, x) for x in out]
+
+
+# ================= DECODER REGISTRY =================
+
+# Кандидаты всегда выдаются в фиксированном порядке (priority, затем порядок
+# регистрации): какие варианты переживут max_generated_nodes, не зависит от
+# процесса и времени работы.
+#
+# Статистика успехов нужна только для бюджета: при DECODE_BUDGET > 0 на каждом
+# узле запускаются декодеры с наибольшей долей успехов на единицу cost, пока их
+# суммарный cost не превысит бюджет (хотя бы один запускается всегда). Это
+# реальная экономия, но набор кандидатов начинает зависеть от статистики.
+# 0 = без бюджета: запускается каждый декодер, чей precondition прошёл.
+DECODE_BUDGET = float(os.getenv("KDEFENDER_DECODE_BUDGET", "0"))
+REORDER_EVERY = 500  # пересчитывать ранжирование для бюджета каждые N вызовов _transforms
+
+_decoders: dict[str, dict] = {}
+_decoder_order: list[dict] = []  # порядок выдачи, фиксированный
+_decoder_rank_order: list[dict] = []  # порядок для бюджета, по статистике
+_calls_since_reorder = 0
+
+
+def register_decoder(
+    name: str,
+    fn,
+    *,
+    precondition=None,
+    cost: float = 1.0,
+    priority: int = 0,
+) -> None:
+    """
+    Регистрирует декодер.
 
-    if _PERCENT_RE.search(s):
-        results.extend(("url", x) for x in _decode_url(s))
+    fn(s, max_out) -> list[str]  — сам декодер
+    precondition(s) -> bool      — дешёвая проверка, без неё fn не вызывается
+    cost                         — относительная оценка стоимости вызова (для DECODE_BUDGET)
+    priority                     — больше = раньше в выдаче и в бюджете
+    """
+    _decoders[name] = {
+        "name": name,
+        "fn": fn,
+        "precondition": precondition,
+        "cost": cost,
+        "priority": priority,
+        "tried": 0,
+        "succeeded": 0,
+    }
+    _reorder_decoders()
 
-    if _HTML_ENTITY_RE.search(s):
-        results.extend(("html", x) for x in _decode_html_entities(s))
 
-    if "\\" in s:
-        results.extend(("unicode_escape", x) for x in _decode_unicode_escapes(s))
-        results.extend(("hex_escape_blob", x) for x in _decode_hex_escapes_blob(s))
+def unregister_decoder(name: str) -> None:
+    _decoders.pop(name, None)
+    _reorder_decoders()
 
-    results.extend(("base32", x) for x in _decode_base32(s, max_out))
-    results.extend(("base85", x) for x in _decode_base85(s, max_out))
-    results.extend(("hex", x) for x in _decode_hex_blob(s, max_out))
 
-    if any(ch.isalpha() for ch in s):
-        results.extend(("rot13", x) for x in _decode_rot13(s))
+def _decoder_rank(decoder: dict) -> tuple:
+    # доля успехов со сглаживанием, чтобы новые декодеры не уходили в конец
+    rate = (decoder["succeeded"] + 1) / (decoder["tried"] + 2)
+    return -decoder["priority"], -rate / max(decoder["cost"], 1e-6)
+
+
+def _reorder_decoders() -> None:
+    global _decoder_order, _decoder_rank_order, _calls_since_reorder
+    # sorted устойчив: при равном priority остаётся порядок регистрации
+    _decoder_order = sorted(_decoders.values(), key=lambda d: -d["priority"])
+    _decoder_rank_order = sorted(_decoders.values(), key=_decoder_rank)
+    _calls_since_reorder = 0
+
+
+def decoder_order() -> list[str]:
+    """Порядок, в котором декодеры выдают кандидатов."""
+    return [d["name"] for d in _decoder_order]
+
+
+def decoder_rank_order() -> list[str]:
+    """Порядок, в котором декодеры получают бюджет (DECODE_BUDGET)."""
+    return [d["name"] for d in _decoder_rank_order]
+
+
+def _budgeted(applicable: list[dict]) -> list[dict]:
+    """Декодеры узла, уложившиеся в DECODE_BUDGET, в порядке выдачи."""
+    if DECODE_BUDGET <= 0 or len(applicable) <= 1:
+        return applicable
+    names = {d["name"] for d in applicable}
+    chosen = set()
+    spent = 0.0
+    for decoder in _decoder_rank_order:
+        if decoder["name"] not in names:
+            continue
+        if chosen and spent + decoder["cost"] > DECODE_BUDGET:
+            break
+        chosen.add(decoder["name"])
+        spent += decoder["cost"]
+    return [d for d in applicable if d["name"] in chosen]
+
+
+def _transforms(s: str, max_out: int, disabled=()) -> list[tuple[str, str]]:
+    """
+    Возвращает список (название_преобразования, результат).
+    disabled — имена декодеров, которые не применяются (например, для конкретного бота).
+    """
+    global _calls_since_reorder
+    if DECODE_BUDGET > 0:
+        with _transform_stats_lock:
+            _calls_since_reorder += 1
+            reorder = _calls_since_reorder >= REORDER_EVERY
+            if reorder:
+                _calls_since_reorder = 0
+        if reorder:
+            _reorder_decoders()
+
+    applicable = []
+    for decoder in _decoder_order:
+        if decoder["name"] in disabled:
+            continue
+        precondition = decoder["precondition"]
+        if precondition is not None and not precondition(s):
+            continue
+        applicable.append(decoder)
+
+    results: list[tuple[str, str]] = []
+    for decoder in _budgeted(applicable):
+        results.extend(_run_transform(decoder, s, max_out))
 
     dedup: list[tuple[str, str]] = []
     seen = set()
@@ -421,6 +676,31 @@ def _transforms(s: str, max_out: int) -> list[tuple[str, str]]:
     return dedup
 
 
+# name, fn(s, max_out), precondition, cost
+register_decoder("base64", _decode_base64, cost=1.0)
+register_decoder("url", lambda s, _: _decode_url(s),
+                 precondition=lambda s: bool(_PERCENT_RE.search(s)), cost=1.0)
+register_decoder("html", lambda s, _: _decode_html_entities(s),
+                 precondition=lambda s: bool(_HTML_ENTITY_RE.search(s)), cost=1.0)
+register_decoder("unicode_escape", lambda s, _: _decode_unicode_escapes(s),
+                 precondition=lambda s: "\\" in s, cost=2.0)
+register_decoder("hex_escape_blob", lambda s, _: _decode_hex_escapes_blob(s),
+                 precondition=lambda s: "\\" in s, cost=1.0)
+register_decoder("base32", _decode_base32, cost=1.5)
+register_decoder("base85", _decode_base85, cost=3.0)
+register_decoder("hex", _decode_hex_blob, cost=1.0)
+register_decoder("rot13", lambda s, _: _decode_rot13(s),
+                 precondition=lambda s: any(ch.isalpha() for ch in s), cost=1.0)
+register_decoder("compressed", _decode_compressed_blob,
+                 precondition=lambda s: s.lstrip().startswith(_COMPRESSED_B64_PREFIXES), cost=3.0)
+register_decoder("jwt", _decode_jwt,
+                 precondition=lambda s: s.lstrip().startswith("eyJ") and s.count(".") == 2, cost=1.5)
+register_decoder("punycode", lambda s, _: _decode_punycode(s),
+                 precondition=lambda s: "xn--" in s or "XN--" in s, cost=1.0)
+register_decoder("quoted_printable", lambda s, _: _decode_quoted_printable(s),
+                 precondition=lambda s: "=" in s and bool(_QP_RE.search(s)), cost=1.0)
+
+
 def generate_normalization_candidates(
     text: str,
     *,
@@ -434,6 +714,7 @@ def generate_normalization_candidates(
     max_generated_nodes: int = 200,
     max_out_per_transform: int = 4096,
     include_original: bool = True,
+    disabled_decoders=(),
 ) -> list[dict]:
     """
     Генерирует все разумные варианты нормализации/декодирования.
@@ -448,6 +729,7 @@ def generate_normalization_candidates(
     """
     raw = "" if text is None else str(text)
     raw = _truncate(raw, max_len)
+    disabled = frozenset(disabled_decoders or ())
 
     def _prepare_pipeline_text(value: str) -> str:
         return _basic_cleanup(
@@ -497,7 +779,7 @@ def generate_normalization_candidates(
         if depth >= max_decode_depth:
             continue
 
-        for transform_name, transformed in _transforms(current, max_out=max_out_per_transform):
+        for transform_name, transformed in _transforms(current, max_out=max_out_per_transform, disabled=disabled):
             pipeline_candidate = _prepare_pipeline_text(transformed)
 
             if not pipeline_candidate or pipeline_candidate in visited:
@@ -540,6 +822,7 @@ def normalize_input(
     return_all_candidates: bool = False,
     join_candidates: bool = False,
     top_k: int = 5,
+    disabled_decoders=(),
 ) -> str | list[dict]:
     """
     Основная функция нормализации.
@@ -548,6 +831,8 @@ def normalize_input(
     - return_all_candidates=True  -> вернуть все кандидаты
     - join_candidates=True        -> вернуть строку из top_k кандидатов через ' || '
     - иначе                       -> вернуть лучший кандидат
+
+    disabled_decoders — имена декодеров из реестра, которые не применять.
     """
     candidates = generate_normalization_candidates(
         text,
@@ -561,6 +846,7 @@ def normalize_input(
         max_generated_nodes=max_generated_nodes,
         max_out_per_transform=max_out_per_transform,
         include_original=True,
+        disabled_decoders=disabled_decoders,
     )
 
     if return_all_candidates:
@@ -0,0 +1,222 @@
+"""
+Online incremental training from owner-labelled production traffic.
+
+Owners answer block alerts in the bot with "Correct block" / "False positive";
+k-defender.py stores that as "verdict" on the bot's log entry (storage.py).
+This process picks up new verdicts, updates a hashed-features SGD model with
+partial_fit (no full retraining) and periodically publishes it to models/,
+where core.py's model watcher hot-swaps it in.
+
+    python online_train.py --base kdefender_ai_hashed.pkl --interval 300 --publish-every 3600
+
+The base model is what `train_model.py --features hashed --stream` saves:
+hashed features need no vocabulary refit and SGDClassifier supports partial_fit.
+
+online/
+  kdefender_ai_hashed.pkl   current learner (base + all updates so far)
+  cursor.json               {"since": last verdict_time used, "samples": N, ...}
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import joblib
+import numpy as np
+
+from dataset_io import DATASET_DIR, iter_samples
+from model_registry import publish
+from storage import get_store
+from native_model import export_native_model
+from klog import get_logger
+
+log = get_logger("online")
+
+ONLINE_DIR = os.getenv("KDEFENDER_ONLINE_DIR", "online")
+MODEL_NAME = "kdefender_ai_hashed"
+CURSOR_FILE = "cursor.json"
+
+FEEDBACK_WEIGHT = 5.0  # one owner verdict outweighs one synthetic sample
+
+
+# ================= SAMPLES =================
+
+def verdict_label(entry, classes):
+    """Training label of a log entry with an owner verdict (None: not usable)."""
+    verdict = entry.get("verdict")
+    if verdict == "allow":
+        return "Safe"
+    if verdict == "block":
+        # Flood / INVALID_TOKEN / LOCKDOWN aren't content classes
+        for reason in entry.get("reason") or []:
+            if reason in classes and reason != "Safe":
+                return reason
+    return None
+
+
+def collect_samples(store, since, classes):
+    """[(text, label, verdict_time)] for verdicts newer than since, oldest first."""
+    samples = []
+    for e in store.labelled_logs(since):
+        label = verdict_label(e, classes)
+        text = e.get("normalized") or e.get("text")
+        if label and text:
+            samples.append((text, label, e["verdict_time"]))
+    samples.sort(key=lambda s: s[2])
+    return samples
+
+
+def load_replay(path, size, seed=42):
+    """Reservoir sample of the synthetic dataset, mixed into updates against drift."""
+    rng = random.Random(seed)
+    pool = []
+    for i, sample in enumerate(iter_samples(path)):
+        if len(pool) < size:
+            pool.append(sample)
+        else:
+            j = rng.randint(0, i)
+            if j < size:
+                pool[j] = sample
+    return pool
+
+
+# ================= LEARNER =================
+
+def load_learner(base):
+    path = os.path.join(ONLINE_DIR, MODEL_NAME + ".pkl")
+    model = joblib.load(path if os.path.exists(path) else base)
+    if not hasattr(model.named_steps["clf"], "partial_fit"):
+        raise ValueError(
+            "online training needs a partial_fit classifier: "
+            "train the base with train_model.py --features hashed --stream"
+        )
+    return model
+
+
+def read_cursor():
+    path = os.path.join(ONLINE_DIR, CURSOR_FILE)
+    if not os.path.exists(path):
+        return {"since": 0.0, "samples": 0, "updates": 0, "published": None}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_learner(model, cursor):
+    """Learner first, cursor second: a crash in between only re-applies one batch."""
+    os.makedirs(ONLINE_DIR, exist_ok=True)
+    path = os.path.join(ONLINE_DIR, MODEL_NAME + ".pkl")
+    joblib.dump(model, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    path = os.path.join(ONLINE_DIR, CURSOR_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(cursor, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def accuracy(model, samples):
+    if not samples:
+        return None
+    texts, labels = zip(*samples)
+    return float(np.mean(model.predict(list(texts)) == np.array(labels)))
+
+
+def update(model, samples, replay, replay_ratio, rng):
+    texts = [s[0] for s in samples]
+    labels = [s[1] for s in samples]
+    weights = [FEEDBACK_WEIGHT] * len(samples)
+
+    if replay:
+        k = min(len(replay), int(len(samples) * replay_ratio))
+        for text, label in rng.sample(replay, k):
+            texts.append(text)
+            labels.append(label)
+            weights.append(1.0)
+
+    clf = model.named_steps["clf"]
+    X = model.named_steps["features"].transform(texts)
+    clf.partial_fit(X, labels, classes=clf.classes_, sample_weight=np.array(weights))
+
+
+def publish_learner(model, version):
+    with tempfile.TemporaryDirectory() as tmp:
+        pkl = os.path.join(tmp, MODEL_NAME + ".pkl")
+        npz = os.path.join(tmp, MODEL_NAME + ".npz")
+        joblib.dump(model, pkl)
+        export_native_model(model, npz)
+        return publish([npz, pkl], version=version)
+
+
+# ================= LOOP =================
+
+def run_once(args, model, cursor, replay, holdout, baseline, rng):
+    """One poll: returns True if the learner was updated."""
+    classes = set(model.named_steps["clf"].classes_)
+    samples = collect_samples(get_store(), cursor["since"], classes)
+    if len(samples) < args.min_samples:
+        return False
+
+    update(model, samples, replay, args.replay_ratio, rng)
+
+    cursor["since"] = samples[-1][2]
+    cursor["samples"] += len(samples)
+    cursor["updates"] += 1
+    save_learner(model, cursor)
+    log.info("online_update", samples=len(samples), total=cursor["samples"], updates=cursor["updates"])
+
+    published = cursor.get("published") or 0
+    if time.time() - published < args.publish_every:
+        return True
+
+    # replay holdout guards against feedback wrecking the synthetic classes
+    score = accuracy(model, holdout)
+    if baseline is not None and score is not None and score < baseline - args.max_drop:
+        log.warning("online_publish_refused", accuracy=score, baseline=baseline, max_drop=args.max_drop)
+        return True
+
+    version = publish_learner(model, "online-" + time.strftime("%Y%m%d-%H%M%S"))
+    cursor["published"] = time.time()
+    save_learner(model, cursor)
+    log.info("online_published", version=version, accuracy=score)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="K-Defender online training from owner verdicts")
+    parser.add_argument("--base", default=MODEL_NAME + ".pkl",
+                        help="starting model when online/ has no learner yet")
+    parser.add_argument("--interval", type=float, default=300, help="seconds between polls for new verdicts")
+    parser.add_argument("--publish-every", type=float, default=3600,
+                        help="min seconds between published model versions")
+    parser.add_argument("--min-samples", type=int, default=20, help="new verdicts needed for an update")
+    parser.add_argument("--replay-dataset", default=DATASET_DIR, help="synthetic dataset mixed into updates ('' = off)")
+    parser.add_argument("--replay-size", type=int, default=20000, help="replay samples kept in memory")
+    parser.add_argument("--replay-ratio", type=float, default=4.0, help="replay samples per verdict")
+    parser.add_argument("--max-drop", type=float, default=0.01,
+                        help="refuse to publish if replay-holdout accuracy drops more than this")
+    parser.add_argument("--once", action="store_true", help="single poll (cron)")
+    args = parser.parse_args()
+
+    model = load_learner(args.base)
+    cursor = read_cursor()
+    rng = random.Random()
+
+    replay, holdout = [], []
+    if args.replay_dataset and os.path.exists(args.replay_dataset):
+        pool = load_replay(args.replay_dataset, args.replay_size)
+        split = len(pool) // 10
+        holdout, replay = pool[:split], pool[split:]
+    baseline = accuracy(joblib.load(args.base), holdout) if holdout else None
+
+    log.info("online_start", since=cursor["since"], replay=len(replay), baseline=baseline)
+    while True:
+        run_once(args, model, cursor, replay, holdout, baseline, rng)
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+In-memory rate limiting for the antiflood check (core.detect_flood).
+
+    limiter = SlidingWindowLimiter(limit=6, window=5)
+    if limiter.hit(("owner_id", "bot_id")):
+        ...  # flood
+
+Exact sliding window: per key a ring (deque(maxlen=limit)) of the last
+`limit` event times. An event is over the limit when the ring is full and its
+oldest entry is less than `window` old, i.e. `limit` events fell within the
+window - the same answer as keeping every timestamp, in O(1) per event and
+bounded memory per key. Nothing goes to state.json. Keys idle for longer than
+idle_ttl (or the least recently used ones beyond max_keys) are evicted.
+
+ShardedLimiter spreads keys over independently locked SlidingWindowLimiters
+(lock striping), so many threads hitting different senders rarely wait on
+each other and eviction only ever scans one shard.
+
+Counters live in the process: with several API processes each has its own.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class SlidingWindowLimiter:
+    def __init__(self, limit, window, idle_ttl=None, max_keys=100_000):
+        self.limit = limit
+        self.window = float(window)
+        # after a window without events a key's ring can't flag anything anymore
+        self.idle_ttl = self.window if idle_ttl is None else idle_ttl
+        self.max_keys = max_keys
+        self._keys = OrderedDict()  # key -> deque of the last `limit` event times, LRU order
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        keys = self._keys
+        while keys:
+            key, ring = next(iter(keys.items()))
+            if now - ring[-1] < self.idle_ttl and len(keys) <= self.max_keys:
+                break
+            del keys[key]
+
+    def hit(self, key, now=None):
+        """Counts one event for key; True if the key is over the limit."""
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            ring = self._keys.get(key)
+            if ring is None:
+                ring = self._keys[key] = deque(maxlen=self.limit)
+            else:
+                self._keys.move_to_end(key)
+            ring.append(now)
+            over = len(ring) == self.limit and now - ring[0] < self.window
+            self._evict(now)
+
+        return over
+
+    def reset(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class ShardedLimiter:
+    def __init__(self, limit, window, shards=64, idle_ttl=None, max_keys=500_000):
+        self._shards = [
+            SlidingWindowLimiter(limit, window, idle_ttl, max(max_keys // shards, 1))
+            for _ in range(shards)
+        ]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def hit(self, key, now=None):
+        return self._shard(key).hit(key, now)
+
+    def reset(self, key):
+        self._shard(key).reset(key)
+
+    def __len__(self):
+        return sum(len(s) for s in self._shards)
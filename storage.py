@@ -0,0 +1,994 @@
+"""
+Storage of users, bots, settings, logs and pending alerts, shared by
+core.py / web-api.py (checks) and k-defender.py (Telegram UI).
+
+    store = get_store()   # KDEFENDER_STORAGE=json (default) / sharded / sqlite
+
+JsonStore     state.json snapshot + state.json.journal: a write appends one
+              line; a background task compacts the journal into a new snapshot.
+ShardedJsonStore
+              the same per owner, state/<uid>.json (KDEFENDER_STATE_DIR), plus
+              a bot -> owner directory.
+SqliteStore   kdefender.db (KDEFENDER_DB) in WAL mode, one indexed table each
+              for users, bots, settings, logs and pending; a check is a few
+              single-row statements instead of a whole-file rewrite.
+
+    python storage.py migrate --state state.json --db kdefender.db
+    python storage.py migrate --state state.json --to sharded --dir state
+
+Both keep the nested dict layout for load_state() (users -> bots -> settings),
+which the Telegram UI works on. The fields the API owns - logs, pending,
+stats_total, stats_blocked, counters - are only changed through record_check /
+push_pending / pop_pending / set_verdict, and save_state() never overwrites
+them with a stale copy. counters are the chart buckets of timebuckets.py.
+"""
+import argparse
+import copy
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import timebuckets
+from klog import get_logger
+
+log = get_logger("storage")
+
+STATE_FILE = "state.json"
+DB_FILE = os.getenv("KDEFENDER_DB", "kdefender.db")
+SHARD_DIR = os.getenv("KDEFENDER_STATE_DIR", "state")
+DIRECTORY_FILE = "directory.json"
+STORAGE = os.getenv("KDEFENDER_STORAGE", "json")  # json / sharded / sqlite
+LOGS_KEEP = 5000  # per bot
+TRIM_EVERY = 64
+COMPACT_BYTES = int(os.getenv("KDEFENDER_JOURNAL_COMPACT", str(4 * 1024 * 1024)))  # journal size -> snapshot
+JOURNAL_FSYNC = os.getenv("KDEFENDER_JOURNAL_FSYNC", "0") == "1"
+
+API_FIELDS = ("logs", "pending", "stats_total", "stats_blocked", "counters")
+# old per-user flood timestamps, now kept in memory (ratelimit.py): dropped on save / migration
+LEGACY_USER_FIELDS = ("Flood",)
+
+
+def _user_bots(state, uid, bot_id):
+    u = state.get(str(uid))
+    b = (u or {}).get("bots", {}).get(str(bot_id))
+    return u, b
+
+
+# ================= JSON =================
+
+def _strip_api(user):
+    """User dict without the API-owned bot fields (what save_state may change)."""
+    out = {k: v for k, v in user.items() if k != "bots" and k not in LEGACY_USER_FIELDS}
+    out["bots"] = {
+        bot_id: {k: v for k, v in b.items() if k not in API_FIELDS}
+        for bot_id, b in (user.get("bots") or {}).items()
+    }
+    return out
+
+
+class JsonStore:
+    """
+    state.json is a snapshot, state.json.journal the changes made since:
+    one compact JSON op per line, each numbered with a sequence number.
+
+    A write appends one line. Every call first replays the journal lines
+    other processes appended since this one last looked, so all processes
+    see the same state. Cross-process locking uses flock on state.json.lock.
+    compact() (run in the background: start_compactor / maybe_compact)
+    writes a new snapshot and starts an empty journal. After a crash, the
+    snapshot is loaded and the journal ops with a higher sequence number
+    are replayed. A torn last line is dropped.
+
+    The first journal line is [base, "base"]: the sequence number of the
+    snapshot it was started from. It names the compaction generation: a
+    process that finds another base (or a journal shorter than what it has
+    read) reloads the snapshot before reading or writing anything, however
+    many compactions it missed.
+    """
+
+    def __init__(self, path=STATE_FILE, compact_bytes=COMPACT_BYTES):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_bytes = compact_bytes
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._pid = None
+        self._state = None
+        self._seq = 0
+        self._base = None
+        self._offset = 0
+        self._compactor_pid = None
+
+    # ---- journal ----
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        with self._lock:
+            if self._pid != os.getpid():
+                # after fork: own lock file description, state re-read from disk
+                self._lock_file = open(self.path + ".lock", "a")
+                self._pid = os.getpid()
+                self._state = None
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._catch_up()
+                yield self._state
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _header(base):
+        return (json.dumps([base, "base"]) + "\n").encode("utf-8")
+
+    @staticmethod
+    def _read_header(f):
+        """(base, header length) of an open journal; (None, 0) if it has none yet."""
+        line = f.readline()
+        if line.endswith(b"\n"):
+            op = json.loads(line)
+            if op[1] == "base":
+                return op[0], len(line)
+        return None, 0
+
+    def _catch_up(self):
+        try:
+            f = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            f = None
+        base, start = self._read_header(f) if f else (None, 0)
+        size = os.fstat(f.fileno()).st_size if f else 0
+
+        if self._state is None or base != self._base or size < self._offset:
+            # first call, or the journal was compacted into a new snapshot
+            state = {}
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as sf:
+                    state = json.load(sf)
+            self._seq = state.pop("_seq", 0)
+            self._state = state
+            self._base = base
+            self._offset = start
+
+        if f is None:
+            return
+        with f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # an incomplete last line is still being written (or torn)
+        for line in data[:end].splitlines():
+            if line:
+                op = json.loads(line)
+                if op[0] > self._seq:
+                    self._apply(op)
+        self._offset += end
+
+    def _commit(self, kind, *args):
+        """Appends one op (exclusive lock held, caught up) and applies it."""
+        if self._base is not None and self._seq < self._base:
+            # never write a seq the snapshot already covers: readers would skip it
+            raise RuntimeError(f"{self.journal_path}: at seq {self._seq}, journal base {self._base}")
+        op = [self._seq + 1, kind, *args]
+        line = (json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with open(self.journal_path, "ab") as f:
+            if f.tell() > self._offset:
+                f.truncate(self._offset)  # torn line of a writer that crashed
+            if self._offset == 0:
+                # first write since the snapshot: the journal starts with its base
+                line = self._header(self._seq) + line
+                self._base = self._seq
+            f.write(line)
+            f.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+        self._offset += len(line)
+        self._apply(op)
+
+    def _apply(self, op):
+        seq, kind, *args = op
+        self._seq = seq
+        getattr(self, "_apply_" + kind)(self._state, *args)
+
+    def compact(self):
+        """Snapshot of the current state, then an empty journal."""
+        with self._locked(exclusive=True) as state:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(dict(state, _seq=self._seq), f, ensure_ascii=False, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+            # a crash before this line replays journal ops <= _seq: they are skipped
+            header = self._header(self._seq)
+            with open(self.journal_path + ".tmp", "wb") as f:
+                f.write(header)
+            os.replace(self.journal_path + ".tmp", self.journal_path)
+            self._base = self._seq
+            self._offset = len(header)
+
+    def maybe_compact(self):
+        try:
+            size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return False
+        if size < self.compact_bytes:
+            return False
+        self.compact()
+        return True
+
+    def start_compactor(self, interval=30):
+        if self._compactor_pid == os.getpid():
+            return
+        self._compactor_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.maybe_compact()
+                except Exception:
+                    log.exception("compact_error", path=self.path)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    # ---- ops (also replayed from the journal) ----
+
+    @staticmethod
+    def _apply_user(state, uid, doc):
+        current = (state.get(uid) or {}).get("bots") or {}
+        for bot_id, b in doc.get("bots", {}).items():
+            for field in API_FIELDS:
+                if field in current.get(bot_id, {}):
+                    b[field] = current[bot_id][field]
+        state[uid] = doc
+
+    @staticmethod
+    def _apply_bot(state, uid, bot_id, fields):
+        _, b = _user_bots(state, uid, bot_id)
+        if b is not None:
+            b.update(fields)
+
+    @staticmethod
+    def _apply_check(state, uid, bot_id, entry, alert, total, blocked, keep, ts):
+        _, b = _user_bots(state, uid, bot_id)
+        if b is None:
+            return
+        b["stats_total"] = b.get("stats_total", 0) + total
+        b["stats_blocked"] = b.get("stats_blocked", 0) + blocked
+        if total:
+            if "counters" not in b:
+                b["counters"] = timebuckets.from_logs(b.get("logs"))
+            timebuckets.add(b["counters"], ts, blocked > 0, total)
+        if entry is not None:
+            logs = b.setdefault("logs", [])
+            logs.append(entry)
+            if len(logs) > keep:
+                del logs[:len(logs) - keep]
+        if alert is not None:
+            b.setdefault("pending", {}).setdefault("alert", []).append(alert)
+
+    @staticmethod
+    def _apply_verdict(state, uid, bot_id, log_time, verdict, verdict_time):
+        _, b = _user_bots(state, uid, bot_id)
+        for e in reversed((b or {}).get("logs") or []):
+            if e.get("time") == log_time:
+                e["verdict"] = verdict
+                e["verdict_time"] = verdict_time
+                return
+
+    @staticmethod
+    def _apply_pending(state, uid, bot_id, kind, item):
+        _, b = _user_bots(state, uid, bot_id)
+        if b is not None:
+            b.setdefault("pending", {}).setdefault(kind, []).append(item)
+
+    @staticmethod
+    def _apply_pop(state):
+        for u in state.values():
+            for b in (u.get("bots") or {}).values():
+                for items in (b.get("pending") or {}).values():
+                    items.clear()
+
+    # ---- store interface ----
+
+    def export_state(self):
+        """Everything, logs and pending included (migration)."""
+        with self._locked() as state:
+            return copy.deepcopy(state)
+
+    def load_state(self):
+        """Users and bots without logs, pending and counters (as SqliteStore)."""
+        with self._locked() as state:
+            out = {}
+            for uid, u in state.items():
+                user = copy.deepcopy(_strip_api(u))
+                for bot_id, b in user["bots"].items():
+                    src = u["bots"][bot_id]
+                    b["stats_total"] = src.get("stats_total", 0)
+                    b["stats_blocked"] = src.get("stats_blocked", 0)
+                out[uid] = user
+            return out
+
+    def save_state(self, state):
+        """Journals the users that changed; unchanged ones cost nothing."""
+        with self._locked(exclusive=True) as current:
+            for uid, u in state.items():
+                uid = str(uid)
+                doc = _strip_api(u)
+                if (uid in current and _strip_api(current[uid]) == doc
+                        and not any(k in current[uid] for k in LEGACY_USER_FIELDS)):
+                    continue
+                self._commit("user", uid, copy.deepcopy(doc))
+
+    def find_bot(self, bot_id):
+        """(owner uid, user, bot) of a connected bot, or (None, None, None)."""
+        with self._locked() as state:
+            for uid, u in state.items():
+                bot = (u.get("bots") or {}).get(str(bot_id))
+                if bot is not None:
+                    user = copy.deepcopy({k: v for k, v in u.items() if k != "bots"})
+                    bot = copy.deepcopy({k: v for k, v in bot.items() if k not in ("logs", "counters", "pending")})
+                    return uid, user, bot
+        return None, None, None
+
+    def update_bot(self, uid, bot_id, **fields):
+        with self._locked(exclusive=True) as state:
+            if _user_bots(state, uid, bot_id)[1] is None:
+                return False
+            self._commit("bot", str(uid), str(bot_id), fields)
+            return True
+
+    def record_check(self, uid, bot_id, entry=None, alert=None, total=1, blocked=0, keep=LOGS_KEEP):
+        """Stats, log entry and block alert of one check: one journal line."""
+        ts = entry.get("time", time.time()) if entry else time.time()
+        with self._locked(exclusive=True) as state:
+            if _user_bots(state, uid, bot_id)[1] is not None:
+                self._commit("check", str(uid), str(bot_id), entry, alert, total, blocked, keep, ts)
+
+    def get_logs(self, uid, bot_id, since=None):
+        """Log entries of a bot, oldest first."""
+        with self._locked() as state:
+            _, b = _user_bots(state, uid, bot_id)
+            logs = list((b or {}).get("logs") or [])
+        if since is not None:
+            logs = [e for e in logs if isinstance(e.get("time"), (int, float)) and e["time"] >= since]
+        return logs
+
+    def get_counters(self, uid, bot_id, res, since=None):
+        """[(bucket start, safe, blocked)] at resolution res (timebuckets.RESOLUTIONS)."""
+        with self._locked() as state:
+            _, b = _user_bots(state, uid, bot_id)
+            b = b or {}
+            counters = b["counters"] if "counters" in b else timebuckets.from_logs(b.get("logs"))
+            return timebuckets.rows(counters, res, since)
+
+    def labelled_logs(self, since=0.0):
+        """Entries with an owner verdict newer than since."""
+        out = []
+        with self._locked() as state:
+            for u in state.values():
+                for b in (u.get("bots") or {}).values():
+                    for e in b.get("logs") or []:
+                        t = e.get("verdict_time")
+                        if isinstance(t, (int, float)) and t > since:
+                            out.append(e)
+        return out
+
+    def set_verdict(self, uid, bot_id, log_time, verdict):
+        with self._locked(exclusive=True) as state:
+            _, b = _user_bots(state, uid, bot_id)
+            if not any(e.get("time") == log_time for e in (b or {}).get("logs") or []):
+                return False
+            self._commit("verdict", str(uid), str(bot_id), log_time, verdict, time.time())
+            return True
+
+    def push_pending(self, uid, bot_id, kind, item):
+        with self._locked(exclusive=True) as state:
+            if _user_bots(state, uid, bot_id)[1] is not None:
+                self._commit("pending", str(uid), str(bot_id), kind, item)
+
+    def pop_pending(self):
+        """[(uid, bot_id, kind, item)] queued for the Telegram bot, removed from storage."""
+        with self._locked(exclusive=True) as state:
+            out = []
+            for uid, u in state.items():
+                for bot_id, b in (u.get("bots") or {}).items():
+                    for kind, items in (b.get("pending") or {}).items():
+                        out += [(uid, bot_id, kind, item) for item in items]
+            if out:
+                self._commit("pop")
+            return out
+
+
+# ================= SHARDED JSON =================
+
+_SHARD_NAME = re.compile(r"-?\w+")
+
+
+class ShardedJsonStore:
+    """
+    One journaled JsonStore per owner: state/<uid>.json (+ .journal, .lock).
+    A check for one owner's bot replays, appends to and compacts only that
+    owner's shard, and never waits on another owner's lock. Shards are opened
+    lazily, on first use.
+
+    state/directory.json maps bot_id -> owner uid for find_bot. It is rebuilt
+    by scanning the shards when missing, and updated when save_state sees a
+    user's set of bots change.
+    """
+
+    def __init__(self, path=SHARD_DIR, compact_bytes=COMPACT_BYTES):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._directory = None
+        self._directory_mtime = None
+        self._compactor_pid = None
+        os.makedirs(path, exist_ok=True)
+
+    def _shard(self, uid):
+        uid = str(uid)
+        if not _SHARD_NAME.fullmatch(uid):
+            raise ValueError(f"bad user id {uid!r}")
+        with self._lock:
+            shard = self._shards.get(uid)
+            if shard is None:
+                shard = self._shards[uid] = JsonStore(os.path.join(self.path, uid + ".json"), self.compact_bytes)
+            return shard
+
+    def _uids(self):
+        """Owners with a shard on disk (a new shard may have only a journal yet)."""
+        return sorted({
+            name.split(".")[0] for name in os.listdir(self.path)
+            if name.endswith((".json", ".json.journal")) and name != DIRECTORY_FILE
+        })
+
+    # ---- directory ----
+
+    @contextmanager
+    def _directory_locked(self):
+        with open(os.path.join(self.path, DIRECTORY_FILE + ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write_directory(self, directory):
+        path = os.path.join(self.path, DIRECTORY_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(directory, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    def _scan_directory(self):
+        directory = {}
+        for uid in self._uids():
+            for bot_id in self._shard(uid).load_state().get(uid, {}).get("bots", {}):
+                directory[bot_id] = uid
+        return directory
+
+    def _load_directory(self, locked=False):
+        path = os.path.join(self.path, DIRECTORY_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if locked:
+                return self._scan_directory()
+            with self._directory_locked():
+                if not os.path.exists(path):
+                    self._write_directory(self._scan_directory())
+            return self._load_directory()
+
+        if mtime != self._directory_mtime:
+            with open(path, "r", encoding="utf-8") as f:
+                self._directory = json.load(f)
+            self._directory_mtime = mtime
+        return self._directory
+
+    def _update_directory(self, uid, old_bots, new_bots):
+        with self._directory_locked():
+            directory = dict(self._load_directory(locked=True))
+            for bot_id in old_bots - new_bots:
+                if directory.get(bot_id) == uid:
+                    del directory[bot_id]
+            for bot_id in new_bots:
+                directory[bot_id] = uid
+            self._write_directory(directory)
+
+    def _owner(self, bot_id):
+        return self._load_directory().get(str(bot_id))
+
+    # ---- store interface ----
+
+    def export_state(self):
+        state = {}
+        for uid in self._uids():
+            state.update(self._shard(uid).export_state())
+        return state
+
+    def load_state(self):
+        state = {}
+        for uid in self._uids():
+            state.update(self._shard(uid).load_state())
+        return state
+
+    def save_state(self, state):
+        for uid, u in state.items():
+            uid = str(uid)
+            shard = self._shard(uid)
+            old_bots = set(shard.load_state().get(uid, {}).get("bots", {}))
+            shard.save_state({uid: u})
+            new_bots = set((u.get("bots") or {}))
+            if old_bots != new_bots:
+                self._update_directory(uid, old_bots, new_bots)
+
+    def find_bot(self, bot_id):
+        uid = self._owner(bot_id)
+        if uid is None:
+            return None, None, None
+        return self._shard(uid).find_bot(bot_id)
+
+    def update_bot(self, uid, bot_id, **fields):
+        return self._shard(uid).update_bot(uid, bot_id, **fields)
+
+    def record_check(self, uid, bot_id, entry=None, alert=None, total=1, blocked=0, keep=LOGS_KEEP):
+        self._shard(uid).record_check(uid, bot_id, entry, alert, total, blocked, keep)
+
+    def get_logs(self, uid, bot_id, since=None):
+        return self._shard(uid).get_logs(uid, bot_id, since)
+
+    def get_counters(self, uid, bot_id, res, since=None):
+        return self._shard(uid).get_counters(uid, bot_id, res, since)
+
+    def labelled_logs(self, since=0.0):
+        for uid in self._uids():
+            yield from self._shard(uid).labelled_logs(since)
+
+    def set_verdict(self, uid, bot_id, log_time, verdict):
+        return self._shard(uid).set_verdict(uid, bot_id, log_time, verdict)
+
+    def push_pending(self, uid, bot_id, kind, item):
+        self._shard(uid).push_pending(uid, bot_id, kind, item)
+
+    def pop_pending(self):
+        out = []
+        for uid in self._uids():
+            out += self._shard(uid).pop_pending()
+        return out
+
+    def maybe_compact(self):
+        with self._lock:
+            shards = list(self._shards.values())
+        return sum(shard.maybe_compact() for shard in shards) > 0
+
+    def start_compactor(self, interval=30):
+        if self._compactor_pid == os.getpid():
+            return
+        self._compactor_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.maybe_compact()
+                except Exception:
+                    log.exception("compact_error", path=self.path)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def import_state(self, state):
+        """Splits a state dict (with logs and pending) into per-owner shards."""
+        for uid, u in state.items():
+            shard = self._shard(uid)
+            u = {k: v for k, v in u.items() if k not in LEGACY_USER_FIELDS}
+            with open(shard.path, "w", encoding="utf-8") as f:
+                json.dump({uid: u}, f, ensure_ascii=False, separators=(",", ":"))
+        self._write_directory({
+            bot_id: uid for uid, u in state.items() for bot_id in (u.get("bots") or {})
+        })
+
+
+# ================= SQLITE =================
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    data TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS bots (
+    uid TEXT NOT NULL,
+    bot_id TEXT NOT NULL,
+    data TEXT NOT NULL DEFAULT '{}',
+    stats_total INTEGER NOT NULL DEFAULT 0,
+    stats_blocked INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (uid, bot_id)
+);
+CREATE INDEX IF NOT EXISTS bots_by_id ON bots (bot_id);
+CREATE TABLE IF NOT EXISTS settings (
+    uid TEXT NOT NULL,
+    bot_id TEXT NOT NULL,           -- '' for user settings
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (uid, bot_id, key)
+);
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL,
+    bot_id TEXT NOT NULL,
+    time REAL NOT NULL,
+    status TEXT,
+    verdict_time REAL,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_by_bot_time ON logs (uid, bot_id, time);
+CREATE INDEX IF NOT EXISTS logs_by_verdict ON logs (verdict_time) WHERE verdict_time IS NOT NULL;
+CREATE TABLE IF NOT EXISTS counters (
+    uid TEXT NOT NULL,
+    bot_id TEXT NOT NULL,
+    res INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    safe INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (uid, bot_id, res, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pending (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL,
+    bot_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    item TEXT NOT NULL
+);
+"""
+
+
+def _dumps(v):
+    return json.dumps(v, ensure_ascii=False)
+
+
+class SqliteStore:
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._local = threading.local()
+        self._saved = {}  # uid -> _strip_api(user) as JSON, as last loaded / saved by this process
+        self._saved_pid = os.getpid()
+        self._saved_lock = threading.Lock()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self):
+        # one connection per thread, and a new one after fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def maybe_compact(self):
+        # WAL checkpoints run on their own; this only keeps the -wal file short
+        self._conn().execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return False
+
+    def start_compactor(self, interval=30):
+        pass
+
+    # ---- whole state (Telegram UI) ----
+
+    def _settings(self, conn, uid=None):
+        out = {}
+        sql = "SELECT uid, bot_id, key, value FROM settings"
+        rows = conn.execute(sql + " WHERE uid = ?", (uid,)) if uid is not None else conn.execute(sql)
+        for u, bot_id, key, value in rows:
+            out.setdefault((u, bot_id), {})[key] = json.loads(value)
+        return out
+
+    def _bot(self, data, stats_total, stats_blocked, settings):
+        b = json.loads(data)
+        b["settings"] = settings
+        b["stats_total"] = stats_total
+        b["stats_blocked"] = stats_blocked
+        return b
+
+    def _remember(self, state):
+        with self._saved_lock:
+            if self._saved_pid != os.getpid():
+                self._saved, self._saved_pid = {}, os.getpid()
+            for uid, u in state.items():
+                self._saved[uid] = _dumps(_strip_api(u))
+
+    def _changed(self, state):
+        """Users of state that differ from what this process last loaded / saved."""
+        with self._saved_lock:
+            if self._saved_pid != os.getpid():
+                self._saved, self._saved_pid = {}, os.getpid()
+            return {uid: u for uid, u in state.items() if self._saved.get(uid) != _dumps(_strip_api(u))}
+
+    def load_state(self):
+        conn = self._conn()
+        settings = self._settings(conn)
+        state = {}
+        for uid, data in conn.execute("SELECT uid, data FROM users"):
+            u = json.loads(data)
+            u["settings"] = settings.get((uid, ""), {})
+            u["bots"] = {}
+            state[uid] = u
+        for uid, bot_id, data, total, blocked in conn.execute(
+            "SELECT uid, bot_id, data, stats_total, stats_blocked FROM bots"
+        ):
+            u = state.setdefault(uid, {"settings": {}, "bots": {}})
+            u["bots"][bot_id] = self._bot(data, total, blocked, settings.get((uid, bot_id), {}))
+        self._remember(state)
+        return state
+
+    def save_state(self, state):
+        """
+        Upserts the users that changed since this process last loaded / saved
+        them (as JsonStore, unchanged ones cost no write); bots missing from a
+        user are deleted.
+        """
+        changed = self._changed({str(uid): u for uid, u in state.items()})
+        if not changed:
+            return
+        conn = self._conn()
+        with conn:
+            for uid, u in changed.items():
+                self._save_user(conn, uid, u)
+        self._remember(changed)
+
+    def save_user(self, uid, user):
+        conn = self._conn()
+        with conn:
+            self._save_user(conn, str(uid), user)
+        self._remember({str(uid): user})
+
+    def _save_user(self, conn, uid, u):
+        data = {k: v for k, v in u.items() if k not in ("bots", "settings") + LEGACY_USER_FIELDS}
+        conn.execute(
+            "INSERT INTO users (uid, data) VALUES (?, ?) ON CONFLICT (uid) DO UPDATE SET data = excluded.data",
+            (uid, _dumps(data)),
+        )
+        self._save_settings(conn, uid, "", u.get("settings") or {})
+
+        bots = u.get("bots") or {}
+        for bot_id, b in bots.items():
+            data = {k: v for k, v in b.items() if k not in API_FIELDS and k != "settings"}
+            conn.execute(
+                "INSERT INTO bots (uid, bot_id, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (uid, bot_id) DO UPDATE SET data = excluded.data",
+                (uid, bot_id, _dumps(data)),
+            )
+            self._save_settings(conn, uid, bot_id, b.get("settings") or {})
+
+        gone = [bot_id for (bot_id,) in conn.execute("SELECT bot_id FROM bots WHERE uid = ?", (uid,))
+                if bot_id not in bots]
+        for bot_id in gone:
+            for table in ("bots", "settings", "logs", "counters", "pending"):
+                conn.execute(f"DELETE FROM {table} WHERE uid = ? AND bot_id = ?", (uid, bot_id))
+
+    def _save_settings(self, conn, uid, bot_id, settings):
+        conn.execute("DELETE FROM settings WHERE uid = ? AND bot_id = ?", (uid, bot_id))
+        conn.executemany(
+            "INSERT INTO settings (uid, bot_id, key, value) VALUES (?, ?, ?, ?)",
+            [(uid, bot_id, k, _dumps(v)) for k, v in settings.items()],
+        )
+
+    # ---- checks (API) ----
+
+    def find_bot(self, bot_id):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT uid, data, stats_total, stats_blocked FROM bots WHERE bot_id = ? LIMIT 1",
+            (str(bot_id),),
+        ).fetchone()
+        if row is None:
+            return None, None, None
+        uid = row[0]
+        settings = self._settings(conn, uid)
+        user_row = conn.execute("SELECT data FROM users WHERE uid = ?", (uid,)).fetchone()
+        user = json.loads(user_row[0]) if user_row else {}
+        user["settings"] = settings.get((uid, ""), {})
+        return uid, user, self._bot(row[1], row[2], row[3], settings.get((uid, str(bot_id)), {}))
+
+    def update_bot(self, uid, bot_id, **fields):
+        conn = self._conn()
+        with conn:
+            row = conn.execute(
+                "SELECT data FROM bots WHERE uid = ? AND bot_id = ?", (str(uid), str(bot_id))
+            ).fetchone()
+            if row is None:
+                return False
+            data = json.loads(row[0])
+            data.update(fields)
+            conn.execute(
+                "UPDATE bots SET data = ? WHERE uid = ? AND bot_id = ?", (_dumps(data), str(uid), str(bot_id))
+            )
+            return True
+
+    def record_check(self, uid, bot_id, entry=None, alert=None, total=1, blocked=0, keep=LOGS_KEEP):
+        uid, bot_id = str(uid), str(bot_id)
+        ts = entry.get("time", time.time()) if entry else time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "UPDATE bots SET stats_total = stats_total + ?, stats_blocked = stats_blocked + ? "
+                "WHERE uid = ? AND bot_id = ?",
+                (total, blocked, uid, bot_id),
+            )
+            if total:
+                self._add_counters(conn, uid, bot_id, ts, blocked > 0, total)
+            if entry is not None:
+                row_id = conn.execute(
+                    "INSERT INTO logs (uid, bot_id, time, status, entry) VALUES (?, ?, ?, ?, ?)",
+                    (uid, bot_id, entry.get("time", time.time()), entry.get("status"), _dumps(entry)),
+                ).lastrowid
+                # trimming walks `keep` index entries: done every TRIM_EVERY inserts, not on each
+                if row_id % TRIM_EVERY == 0:
+                    conn.execute(
+                        "DELETE FROM logs WHERE uid = ? AND bot_id = ? AND time < ("
+                        "  SELECT time FROM logs WHERE uid = ? AND bot_id = ? ORDER BY time DESC"
+                        "  LIMIT 1 OFFSET ?)",
+                        (uid, bot_id, uid, bot_id, keep - 1),
+                    )
+                    for res in timebuckets.RESOLUTIONS:
+                        conn.execute(
+                            "DELETE FROM counters WHERE uid = ? AND bot_id = ? AND res = ? AND bucket < ?",
+                            (uid, bot_id, res, timebuckets.bucket_start(ts, res) - timebuckets.RETENTION[res]),
+                        )
+            if alert is not None:
+                conn.execute(
+                    "INSERT INTO pending (uid, bot_id, kind, item) VALUES (?, ?, 'alert', ?)",
+                    (uid, bot_id, _dumps(alert)),
+                )
+
+    def _add_counters(self, conn, uid, bot_id, ts, is_blocked, n):
+        column = "blocked" if is_blocked else "safe"
+        conn.executemany(
+            f"INSERT INTO counters (uid, bot_id, res, bucket, {column}) VALUES (?, ?, ?, ?, ?) "
+            f"ON CONFLICT (uid, bot_id, res, bucket) DO UPDATE SET {column} = {column} + excluded.{column}",
+            [(uid, bot_id, res, timebuckets.bucket_start(ts, res), n) for res in timebuckets.RESOLUTIONS],
+        )
+
+    def get_counters(self, uid, bot_id, res, since=None):
+        return self._conn().execute(
+            "SELECT bucket, safe, blocked FROM counters WHERE uid = ? AND bot_id = ? AND res = ? AND bucket > ?",
+            (str(uid), str(bot_id), res, (since or 0) - res),
+        ).fetchall()
+
+    def get_logs(self, uid, bot_id, since=None):
+        sql = "SELECT entry FROM logs WHERE uid = ? AND bot_id = ?"
+        params = [str(uid), str(bot_id)]
+        if since is not None:
+            sql += " AND time >= ?"
+            params.append(since)
+        entries = [json.loads(e) for (e,) in self._conn().execute(sql + " ORDER BY time, id", params)]
+        return entries[-LOGS_KEEP:] if since is None else entries
+
+    def labelled_logs(self, since=0.0):
+        rows = self._conn().execute(
+            "SELECT entry FROM logs WHERE verdict_time > ? ORDER BY verdict_time", (since,)
+        )
+        for (e,) in rows:
+            yield json.loads(e)
+
+    def set_verdict(self, uid, bot_id, log_time, verdict):
+        conn = self._conn()
+        with conn:
+            row = conn.execute(
+                "SELECT id, entry FROM logs WHERE uid = ? AND bot_id = ? AND time = ? ORDER BY id DESC LIMIT 1",
+                (str(uid), str(bot_id), log_time),
+            ).fetchone()
+            if row is None:
+                return False
+            now = time.time()
+            entry = json.loads(row[1])
+            entry["verdict"] = verdict
+            entry["verdict_time"] = now
+            conn.execute("UPDATE logs SET entry = ?, verdict_time = ? WHERE id = ?", (_dumps(entry), now, row[0]))
+            return True
+
+    def push_pending(self, uid, bot_id, kind, item):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO pending (uid, bot_id, kind, item) VALUES (?, ?, ?, ?)",
+                (str(uid), str(bot_id), kind, _dumps(item)),
+            )
+
+    def pop_pending(self):
+        conn = self._conn()
+        with conn:
+            rows = conn.execute("SELECT id, uid, bot_id, kind, item FROM pending ORDER BY id").fetchall()
+            if rows:
+                conn.execute("DELETE FROM pending WHERE id <= ?", (rows[-1][0],))
+        return [(uid, bot_id, kind, json.loads(item)) for _, uid, bot_id, kind, item in rows]
+
+    # ---- migration ----
+
+    def import_state(self, state):
+        """Copies a state.json dict (with logs and pending) into the database."""
+        self.save_state(state)
+        conn = self._conn()
+        with conn:
+            for uid, u in state.items():
+                for bot_id, b in (u.get("bots") or {}).items():
+                    conn.execute(
+                        "UPDATE bots SET stats_total = ?, stats_blocked = ? WHERE uid = ? AND bot_id = ?",
+                        (b.get("stats_total", 0), b.get("stats_blocked", 0), uid, bot_id),
+                    )
+                    conn.executemany(
+                        "INSERT INTO logs (uid, bot_id, time, status, verdict_time, entry) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(uid, bot_id, e.get("time", 0), e.get("status"), e.get("verdict_time"), _dumps(e))
+                         for e in b.get("logs") or [] if isinstance(e, dict)],
+                    )
+                    counters = b.get("counters") or timebuckets.from_logs(b.get("logs"))
+                    conn.executemany(
+                        "INSERT INTO counters (uid, bot_id, res, bucket, safe, blocked) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(uid, bot_id, res, bucket, safe, blocked)
+                         for res in timebuckets.RESOLUTIONS
+                         for bucket, safe, blocked in timebuckets.rows(counters, res)],
+                    )
+                    conn.executemany(
+                        "INSERT INTO pending (uid, bot_id, kind, item) VALUES (?, ?, ?, ?)",
+                        [(uid, bot_id, kind, _dumps(item))
+                         for kind, items in (b.get("pending") or {}).items() for item in items],
+                    )
+
+
+# ================= FACTORY =================
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if STORAGE == "sqlite":
+                _store = SqliteStore(DB_FILE)
+            elif STORAGE == "sharded":
+                _store = ShardedJsonStore(SHARD_DIR)
+            elif STORAGE == "json":
+                _store = JsonStore(STATE_FILE)
+            else:
+                raise ValueError(f"unknown KDEFENDER_STORAGE {STORAGE!r} (json / sharded / sqlite)")
+    return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="K-Defender storage tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    migrate = sub.add_parser("migrate", help="copy state.json into an SQLite database or per-owner shards")
+    migrate.add_argument("--state", default=STATE_FILE)
+    migrate.add_argument("--to", choices=["sqlite", "sharded"], default="sqlite")
+    migrate.add_argument("--db", default=DB_FILE)
+    migrate.add_argument("--dir", default=SHARD_DIR)
+    args = parser.parse_args()
+
+    state = JsonStore(args.state).export_state()  # snapshot + journal
+    n_bots = sum(len(u.get("bots") or {}) for u in state.values())
+
+    if args.to == "sqlite":
+        if os.path.exists(args.db):
+            raise SystemExit(f"{args.db} already exists, refusing to migrate into it")
+        SqliteStore(args.db).import_state(state)
+        print(f"Migrated {len(state)} users, {n_bots} bots into {args.db}")
+        print("Start the API and the bot with KDEFENDER_STORAGE=sqlite KDEFENDER_DB=" + args.db)
+    else:
+        if os.path.isdir(args.dir) and os.listdir(args.dir):
+            raise SystemExit(f"{args.dir} is not empty, refusing to migrate into it")
+        ShardedJsonStore(args.dir).import_state(state)
+        print(f"Migrated {len(state)} users, {n_bots} bots into {args.dir}/")
+        print("Start the API and the bot with KDEFENDER_STORAGE=sharded KDEFENDER_STATE_DIR=" + args.dir)
+
+
+if __name__ == "__main__":
+    main()
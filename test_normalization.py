@@ -0,0 +1,69 @@
+import random
+
+from normalization import _SIGNAL_KEYWORDS, _signal_score, normalize_input
+
+SAMPLES = [  # as in normalization.py __main__
+    "PHNjcmlwdD5hbGVydCgxKTwvc2NyaXB0Pg==",
+    "JTNDc2NyaXB0JTNFYWxlcnQoMSklM0Mvc2NyaXB0JTNF",
+    "UEhOamNtbHdkRDVoYkdWeWRDZ3hLVHd2YzJOeWFYQjBQZz09",
+    "%2555%256e%2569%256f%256e%2520%2553%2545%254c%2545%2543%2554",
+    "\\x3c\\x73\\x63\\x72\\x69\\x70\\x74\\x3ealert(1)\\x3c\\x2f\\x73\\x63\\x72\\x69\\x70\\x74\\x3e",
+]
+
+
+def _signal_score_reference(s: str) -> float:
+    # the per-keyword / per-class scan _signal_score replaced
+    if not s:
+        return -10
+
+    score = 0
+    lowered = s.lower()
+    keywords = [
+        "union select", "select", "insert", "drop", "delete",
+        "<script", "javascript:", "alert(", "onerror", "onload",
+    ]
+    for k in keywords:
+        if k in lowered:
+            score += 8
+
+    if "<" in s and ">" in s:
+        score += 2
+
+    score += sum(c.isalpha() for c in s) * 0.05
+    score -= sum(not c.isprintable() for c in s) * 2
+    score -= sum(c in "¦§¤¨©±÷×¼½¾¿" for c in s) * 3
+
+    if "%" in s:
+        score -= 1
+    if "\\" in s:
+        score -= 1
+    return score
+
+
+def _random_text(rng):
+    pieces = list(_SIGNAL_KEYWORDS) + [
+        "UNION SELECT", "<", ">", "%", "\\", "¦§¤¨©±÷×¼½¾¿", "\x00\x07​‮",
+        "abc", "Привет", "日本語", "🙂", "\ud800", " ", "=", "İ",
+    ]
+    parts = []
+    for _ in range(rng.randint(0, 12)):
+        if rng.random() < 0.5:
+            parts.append(rng.choice(pieces))
+        else:
+            parts.append(chr(rng.randint(0, 0x2FFF)))
+    return "".join(parts)
+
+
+def test_signal_score_matches_reference_on_random_strings():
+    rng = random.Random(1234)
+    for _ in range(20000):
+        s = _random_text(rng)
+        assert _signal_score(s) == _signal_score_reference(s), repr(s)
+
+
+def test_signal_score_matches_reference_on_samples():
+    texts = list(SAMPLES)
+    for s in SAMPLES:
+        texts += [item["text"] for item in normalize_input(s, return_all_candidates=True)]
+    for s in texts:
+        assert _signal_score(s) == _signal_score_reference(s), repr(s)
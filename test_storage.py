@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from storage import JsonStore, ShardedJsonStore
+
+
+def _open(kind, tmp_path):
+    # compact_bytes=1: every maybe_compact() call compacts
+    if kind == "json":
+        return JsonStore(os.path.join(tmp_path, "state.json"), compact_bytes=1)
+    return ShardedJsonStore(os.path.join(tmp_path, "state"), compact_bytes=1)
+
+
+@pytest.mark.parametrize("kind", ["json", "sharded"])
+def test_readers_survive_missed_compactions(kind, tmp_path):
+    a = _open(kind, tmp_path)
+    a.save_state({"1": {"settings": {}, "bots": {"5": {"settings": {}}}}})
+    # readers[k] sleeps through k + 1 compactions (journal inodes may be reused meanwhile)
+    readers = [_open(kind, tmp_path) for _ in range(9)]
+    for r in readers:
+        assert r.load_state()["1"]["bots"]["5"]["stats_total"] == 0
+
+    for k, r in enumerate(readers):
+        for _ in range(3):
+            a.record_check("1", "5", entry={"time": float(k)})
+        assert a.maybe_compact()
+
+        state = r.load_state()
+        assert state["1"]["bots"]["5"]["stats_total"] == 3 * (k + 1)
+        state["1"]["settings"][f"r{k}"] = True
+        r.save_state(state)
+
+    fresh = _open(kind, tmp_path).load_state()["1"]
+    assert fresh["settings"] == {f"r{k}": True for k in range(len(readers))}
+    assert fresh["bots"]["5"]["stats_total"] == 3 * len(readers)
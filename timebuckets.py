@@ -0,0 +1,100 @@
+"""
+Pre-aggregated per-bot activity counters for the stats charts.
+
+Every check adds one to its bucket at each resolution (1 min, 10 min, 1 h).
+Only non-empty buckets are stored, and a bucket is dropped once it is older
+than its resolution's retention. A chart reads O(window / resolution)
+buckets and re-buckets them with NumPy, instead of scanning the logs. It
+also covers windows longer than the retained logs (storage.LOGS_KEEP).
+
+JSON form, per bot ("counters"): {"60": {"<bucket start ts>": [safe, blocked]}, "600": {...}, ...}
+"""
+import numpy as np
+
+RESOLUTIONS = (60, 600, 3600)  # seconds
+RETENTION = {60: 2 * 86400, 600: 31 * 86400, 3600: 400 * 86400}
+
+STATUS_SAFE_VALUES = {"safe", "ok", "allowed"}
+STATUS_BLOCKED_VALUES = {"blocked"}
+
+
+def bucket_start(ts, res):
+    return int(ts // res) * res
+
+
+def pick_resolution(window_sec, step_sec):
+    """Coarsest stored resolution that still splits step_sec and covers the window."""
+    fits = [r for r in RESOLUTIONS if step_sec % r == 0 and RETENTION[r] >= window_sec]
+    return max(fits) if fits else RESOLUTIONS[0]
+
+
+def add(counters, ts, blocked, n=1):
+    """Counts n checks at ts in a JSON-form counters dict."""
+    for res in RESOLUTIONS:
+        buckets = counters.setdefault(str(res), {})
+        key = str(bucket_start(ts, res))
+        cell = buckets.get(key)
+        if cell is None:
+            # a new bucket: the moment to drop the expired ones
+            oldest = bucket_start(ts, res) - RETENTION[res]
+            for old in [k for k in buckets if int(k) < oldest]:
+                del buckets[old]
+            cell = buckets[key] = [0, 0]
+        cell[1 if blocked else 0] += n
+
+
+def rows(counters, res, since=None):
+    """[(bucket start, safe, blocked)] of a JSON-form counters dict."""
+    out = []
+    for key, (safe, blocked) in (counters.get(str(res)) or {}).items():
+        start = int(key)
+        if since is None or start + res > since:
+            out.append((start, safe, blocked))
+    return out
+
+
+def _log_status(entry):
+    status = str(entry.get("status") or "").strip().lower()
+    if status in STATUS_BLOCKED_VALUES:
+        return True
+    if status in STATUS_SAFE_VALUES:
+        return False
+    return None
+
+
+def from_logs(logs):
+    """Counters rebuilt from log entries (migration of data without counters)."""
+    counters = {}
+    for e in logs or []:
+        if not isinstance(e, dict):
+            continue
+        try:
+            t = float(e.get("time", 0) or 0)
+        except (TypeError, ValueError):
+            continue
+        blocked = _log_status(e)
+        if t > 0 and blocked is not None:
+            add(counters, t, blocked)
+    return counters
+
+
+def series(bucket_rows, window_sec, step_sec, now_ts):
+    """
+    (step starts, safe, blocked) arrays over [now - window, now], one point
+    per step_sec, from (bucket start, safe, blocked) rows of a resolution
+    that divides step_sec.
+    """
+    start = bucket_start(max(now_ts - window_sec, 0), step_sec)
+    end = max(bucket_start(now_ts, step_sec), start)
+    n = (end - start) // step_sec + 1
+
+    safe = np.zeros(n, dtype=np.int64)
+    blocked = np.zeros(n, dtype=np.int64)
+    if bucket_rows:
+        data = np.asarray(bucket_rows, dtype=np.int64)
+        idx = (data[:, 0] - start) // step_sec
+        keep = (idx >= 0) & (idx < n)
+        safe = np.bincount(idx[keep], weights=data[keep, 1], minlength=n).astype(np.int64)
+        blocked = np.bincount(idx[keep], weights=data[keep, 2], minlength=n).astype(np.int64)
+
+    return start + step_sec * np.arange(n), safe, blocked
@@ -1,70 +1,355 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
 import joblib
 import numpy as np
-from dataset_py import texts, labels
+from joblib import Parallel, delayed
+from scipy import sparse
 
-from sklearn.model_selection import train_test_split
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.model_selection import train_test_split, ParameterGrid
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer, TfidfTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.pipeline import FeatureUnion
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import classification_report, confusion_matrix
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import classification_report, confusion_matrix, accuracy_score, f1_score
 from sklearn.utils import shuffle
 
-print("Total samples:", len(texts))
+from dataset_io import DATASET_DIR, load_dataset, iter_chunks, read_manifest, dataset_hash
+from native_model import export_native_model, NativeScorer, COEF_DTYPES
+from model_registry import publish
+from model_bench import measure, check_gate, format_bench
 
-# Перемешиваем
-texts, labels = shuffle(texts, labels, random_state=42)
+parser = argparse.ArgumentParser(description="Train the K-Defender model")
+parser.add_argument("--dataset", default=DATASET_DIR, help="directory written by make_dataset.py")
+parser.add_argument("--features", choices=["vocab", "hashed"], default="vocab",
+                    help="vocab: TF-IDF vocabularies (default), hashed: fixed-size hashed feature space")
+parser.add_argument("--char-features", type=int, default=2 ** 16, help="hashed mode: char n-gram buckets")
+parser.add_argument("--word-features", type=int, default=2 ** 14, help="hashed mode: word n-gram buckets")
+parser.add_argument("--coef-dtype", choices=COEF_DTYPES, default=None,
+                    help="coefficient storage in the native artifact (default: float64 vocab, int8 hashed)")
+parser.add_argument("--stream", action="store_true",
+                    help="hashed mode: stream the dataset in chunks (SGD), for datasets that don't fit in RAM")
+parser.add_argument("--chunk-size", type=int, default=20000, help="stream mode: samples per chunk")
+parser.add_argument("--epochs", type=int, default=3, help="stream mode: passes over the training data")
+parser.add_argument("--max-test", type=int, default=50000, help="stream mode: cap on held-out samples")
+parser.add_argument("--publish", action="store_true",
+                    help="publish the saved model as a new active version in models/")
+parser.add_argument("--cache-dir", default="feature_cache",
+                    help="fitted feature matrices, keyed by dataset hash and vectorizer params")
+parser.add_argument("--no-cache", action="store_true", help="always re-vectorize")
+parser.add_argument("--sweep", nargs="+", metavar="PARAM=V1,V2",
+                    help="classifier grid on cached features, e.g. --sweep C=0.5,1,4 class_weight=balanced,None; "
+                         "the best setting (macro F1 on a validation slice of the train set) is trained and saved")
+parser.add_argument("--jobs", type=int, default=-1, help="sweep: parallel fits")
+parser.add_argument("--bench-samples", type=int, default=1000, help="test texts used for the latency benchmark")
+parser.add_argument("--bench-batch", type=int, default=64, help="batch size of the batched latency benchmark")
+parser.add_argument("--gate-ratio", type=float, default=1.25,
+                    help="refuse to save if p99 latency exceeds the current model's by this factor (0 = off)")
+parser.add_argument("--gate-p99-ms", type=float, default=None,
+                    help="refuse to save if single-text p99 latency exceeds this many ms")
+args = parser.parse_args()
 
-# Делим данные
-X_train, X_test, y_train, y_test = train_test_split(
-    texts,
-    labels,
-    test_size=0.2,
-    stratify=labels,
-    random_state=42
-)
+if args.stream and args.features != "hashed":
+    parser.error("--stream needs --features hashed (a vocabulary needs all texts in memory)")
+if args.stream and args.sweep:
+    parser.error("--sweep works on in-memory feature matrices, not with --stream")
 
-print("Train size:", len(X_train))
-print("Test size:", len(X_test))
+if args.coef_dtype is None:
+    args.coef_dtype = "float64" if args.features == "vocab" else "int8"
+
+# hashed models are saved next to the production one, not over it
+MODEL_NAME = "kdefender_ai" if args.features == "vocab" else "kdefender_ai_hashed"
+
+# part of the feature cache key: a different split means different matrices
+SPLIT = {"shuffle_seed": 42, "test_size": 0.2, "split_seed": 42}
 
 # ================= FEATURE ENGINEERING =================
 
-char_vectorizer = TfidfVectorizer(
-    analyzer="char",
-    ngram_range=(2,6),
-    max_features=200000,
-    sublinear_tf=True
-)
-
-word_vectorizer = TfidfVectorizer(
-    analyzer="word",
-    ngram_range=(1,2),
-    max_features=50000,
-    sublinear_tf=True
-)
-
-model = Pipeline([
-    ("features", FeatureUnion([
-        ("char", char_vectorizer),
-        ("word", word_vectorizer)
-    ])),
-    ("clf", LogisticRegression(
+def make_classifier():
+    return LogisticRegression(
         max_iter=5000,
         class_weight="balanced",
         n_jobs=-1
-    ))
-])
+    )
+
+def build_vocab_features():
+    char_vectorizer = TfidfVectorizer(
+        analyzer="char",
+        ngram_range=(2,6),
+        max_features=200000,
+        sublinear_tf=True
+    )
+
+    word_vectorizer = TfidfVectorizer(
+        analyzer="word",
+        ngram_range=(1,2),
+        max_features=50000,
+        sublinear_tf=True
+    )
+
+    return FeatureUnion([
+        ("char", char_vectorizer),
+        ("word", word_vectorizer)
+    ])
+
+def build_hashed_features():
+    # без словаря: размер признакового пространства фиксирован
+    def hashed(analyzer, ngram_range, n_features):
+        return Pipeline([
+            ("hash", HashingVectorizer(
+                analyzer=analyzer,
+                ngram_range=ngram_range,
+                n_features=n_features,
+                alternate_sign=False,
+                norm=None
+            )),
+            ("tfidf", TfidfTransformer(sublinear_tf=True))
+        ])
+
+    return FeatureUnion([
+        ("char", hashed("char", (2,6), args.char_features)),
+        ("word", hashed("word", (1,2), args.word_features))
+    ])
+
+def benchmark(name, pipeline, path, coef_dtype):
+    """Accuracy, size and latency of the native artifact core.py would load."""
+    export_native_model(pipeline, path, coef_dtype=coef_dtype)
+    scorer = NativeScorer(path)
+
+    pred = scorer.classes_[scorer.predict_proba(X_test).argmax(axis=1)]
+
+    sample = X_test[:200]
+    started = time.perf_counter()
+    for t in sample:
+        scorer.predict_proba([t])
+    latency = (time.perf_counter() - started) / len(sample)
+
+    return {
+        "model": name,
+        "accuracy": accuracy_score(y_test, pred),
+        "file_kb": os.path.getsize(path) / 1024,
+        "memory_kb": scorer.memory_bytes() / 1024,
+        "latency_ms": latency * 1000,
+    }
+
+def format_comparison(rows):
+    lines = ["%-28s %9s %10s %11s %11s" % ("model", "accuracy", "file KB", "memory KB", "predict ms")]
+    for r in rows:
+        lines.append("%-28s %9.4f %10.0f %11.0f %11.3f" % (
+            r["model"], r["accuracy"], r["file_kb"], r["memory_kb"], r["latency_ms"]
+        ))
+    return "\n".join(lines)
+
+# ================= FEATURE CACHE =================
+
+def _features_key(features, data_hash):
+    params = {k: v for k, v in features.get_params(deep=True).items() if not hasattr(v, "get_params")}
+    raw = json.dumps({"dataset": data_hash, "features": params, "split": SPLIT}, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def cached_features(name, features, X_train, X_test, data_hash):
+    """
+    (fitted features, train matrix, test matrix). Re-used from args.cache_dir
+    when the same dataset was already vectorized with the same parameters.
+    """
+    if args.no_cache:
+        print("Vectorizing (%s)..." % name)
+        return features, features.fit_transform(X_train).tocsr(), features.transform(X_test).tocsr()
+
+    base = os.path.join(args.cache_dir, "%s-%s" % (name, _features_key(features, data_hash)))
+    if os.path.exists(base + ".done"):
+        print("Feature cache hit: " + base)
+        return (joblib.load(base + ".features.pkl"),
+                sparse.load_npz(base + ".train.npz"),
+                sparse.load_npz(base + ".test.npz"))
+
+    print("Vectorizing (%s)..." % name)
+    X_tr = features.fit_transform(X_train).tocsr()
+    X_te = features.transform(X_test).tocsr()
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    joblib.dump(features, base + ".features.pkl")
+    sparse.save_npz(base + ".train.npz", X_tr, compressed=False)
+    sparse.save_npz(base + ".test.npz", X_te, compressed=False)
+    open(base + ".done", "w").close()  # written last: a half-written entry is never used
+    print("Feature cache saved: " + base)
+    return features, X_tr, X_te
+
+# ================= SWEEP =================
+
+def _parse_value(v):
+    if v == "None":
+        return None
+    for cast in (int, float):
+        try:
+            return cast(v)
+        except ValueError:
+            pass
+    return v
+
+def parse_grid(specs):
+    grid = {}
+    for spec in specs:
+        key, _, values = spec.partition("=")
+        if not values:
+            parser.error("--sweep expects PARAM=V1,V2,..., got " + spec)
+        grid[key] = [_parse_value(v) for v in values.split(",")]
+    return list(ParameterGrid(grid))
+
+def _fit_eval(params, X_fit, y_fit, X_val, y_val):
+    clf = make_classifier().set_params(**params)
+    started = time.perf_counter()
+    clf.fit(X_fit, y_fit)
+    fit_s = time.perf_counter() - started
+    pred = clf.predict(X_val)
+    return {
+        "params": params,
+        "accuracy": accuracy_score(y_val, pred),
+        "macro_f1": f1_score(y_val, pred, average="macro"),
+        "fit_s": fit_s,
+    }
+
+def sweep(X, y):
+    """Fits every grid point on the same cached matrix in parallel, best first."""
+    grid = parse_grid(args.sweep)
+    n_val = max(X.shape[0] // 5, 1)  # the train set is already shuffled
+    X_fit, X_val = X[:-n_val], X[-n_val:]
+    y_fit, y_val = y[:-n_val], y[-n_val:]
+
+    print("Sweeping %d classifier settings..." % len(grid))
+    results = Parallel(n_jobs=args.jobs)(
+        delayed(_fit_eval)(params, X_fit, y_fit, X_val, y_val) for params in grid
+    )
+    return sorted(results, key=lambda r: r["macro_f1"], reverse=True)
+
+def format_sweep(results):
+    lines = ["%-44s %9s %9s %8s" % ("params", "accuracy", "macro F1", "fit s")]
+    for r in results:
+        params = ", ".join("%s=%s" % kv for kv in sorted(r["params"].items()))
+        lines.append("%-44s %9.4f %9.4f %8.1f" % (params, r["accuracy"], r["macro_f1"], r["fit_s"]))
+    return "\n".join(lines)
+
+# ================= STREAMING =================
+
+def _stream_split(offset, texts, labels):
+    """Каждый 5-й образец (до --max-test) — в тест; зависит только от позиции."""
+    train_t, train_y, test_t, test_y = [], [], [], []
+    for i, (t, y) in enumerate(zip(texts, labels), offset):
+        if i % 5 == 0 and i // 5 < args.max_test:
+            test_t.append(t)
+            test_y.append(y)
+        else:
+            train_t.append(t)
+            train_y.append(y)
+    return train_t, train_y, test_t, test_y
+
+def stream_train():
+    """
+    Two kinds of passes over the shards, one chunk in memory at a time:
+    document frequencies for the IDF weights, then SGD partial_fit epochs.
+    make_dataset.py already shuffles the samples.
+    """
+    manifest = read_manifest(args.dataset)
+    counts = manifest["labels"]
+    classes = np.array(sorted(counts))
+    weights = {c: manifest["samples"] / (len(classes) * counts[c]) for c in classes}
+
+    features = build_hashed_features()
+    branches = [branch for _, branch in features.transformer_list]
+
+    print("Pass 1: document frequencies...")
+    df = [np.zeros(b.named_steps["hash"].n_features) for b in branches]
+    n_docs = 0
+    test_texts, test_labels = [], []
+    offset = 0
+    for texts, labels in iter_chunks(args.dataset, args.chunk_size):
+        train_t, _, test_t, test_y = _stream_split(offset, texts, labels)
+        offset += len(texts)
+        test_texts += test_t
+        test_labels += test_y
+        for d, b in zip(df, branches):
+            d += np.bincount(b.named_steps["hash"].transform(train_t).indices, minlength=len(d))
+        n_docs += len(train_t)
+
+    for d, b in zip(df, branches):
+        tfidf = b.named_steps["tfidf"]
+        tfidf.idf_ = np.log((1 + n_docs) / (1 + d)) + 1  # smooth_idf, как в sklearn
+        tfidf.n_features_in_ = len(d)
+
+    clf = SGDClassifier(loss="log_loss", alpha=1e-6, class_weight=weights, random_state=42)
+    for epoch in range(args.epochs):
+        print("Pass %d: epoch %d/%d..." % (epoch + 2, epoch + 1, args.epochs))
+        offset = 0
+        for texts, labels in iter_chunks(args.dataset, args.chunk_size):
+            train_t, train_y, _, _ = _stream_split(offset, texts, labels)
+            offset += len(texts)
+            clf.partial_fit(features.transform(train_t), train_y, classes=classes)
+
+    model = Pipeline([("features", features), ("clf", clf)])
+    return model, manifest["samples"], n_docs, test_texts, test_labels
 
 # ================= TRAIN =================
 
-print("Training model...")
-model.fit(X_train, y_train)
+X_test_matrix = None
+sweep_table = None
+
+if args.stream:
+    model, n_samples, n_train, X_test, y_test = stream_train()
+    print("Total samples:", n_samples)
+    print("Train size:", n_train)
+    print("Test size:", len(X_test))
+else:
+    texts, labels = load_dataset(args.dataset)
+    n_samples = len(texts)
+    print("Total samples:", n_samples)
+
+    # Перемешиваем
+    texts, labels = shuffle(texts, labels, random_state=SPLIT["shuffle_seed"])
+
+    # Делим данные
+    X_train, X_test, y_train, y_test = train_test_split(
+        texts,
+        labels,
+        test_size=SPLIT["test_size"],
+        stratify=labels,
+        random_state=SPLIT["split_seed"]
+    )
+
+    print("Train size:", len(X_train))
+    print("Test size:", len(X_test))
+
+    data_hash = dataset_hash(args.dataset)
+    features, X_train_matrix, X_test_matrix = cached_features(
+        args.features,
+        build_vocab_features() if args.features == "vocab" else build_hashed_features(),
+        X_train, X_test, data_hash
+    )
+
+    clf_params = {}
+    if args.sweep:
+        results = sweep(X_train_matrix, y_train)
+        sweep_table = format_sweep(results)
+        print("\n=== Sweep ===")
+        print(sweep_table)
+        clf_params = results[0]["params"]
+        print("Best:", clf_params)
+
+    print("Training model...")
+    clf = make_classifier().set_params(**clf_params).fit(X_train_matrix, y_train)
+    model = Pipeline([("features", features), ("clf", clf)])
 
 print("Training complete.")
 
 # ================= EVALUATION =================
 
-y_pred = model.predict(X_test)
+if X_test_matrix is None:
+    y_pred = model.predict(X_test)
+else:
+    y_pred = model.named_steps["clf"].predict(X_test_matrix)
 
 print("\n=== Classification Report ===")
 report = classification_report(y_test, y_pred)
@@ -74,15 +359,84 @@ print("\n=== Confusion Matrix ===")
 cm = confusion_matrix(y_test, y_pred)
 print(cm)
 
+comparison = None
+if args.features == "hashed" and not args.stream:
+    print("\nTraining vocabulary model for comparison...")
+    vocab_features, vocab_train, _ = cached_features("vocab", build_vocab_features(), X_train, X_test, data_hash)
+    baseline = Pipeline([("features", vocab_features), ("clf", make_classifier().fit(vocab_train, y_train))])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        comparison = format_comparison([
+            benchmark("vocab (float64)", baseline, os.path.join(tmp, "vocab.npz"), "float64"),
+            benchmark("hashed (%s)" % args.coef_dtype, model, os.path.join(tmp, "hashed.npz"), args.coef_dtype),
+        ])
+
+    print("\n=== Hashed vs vocabulary model ===")
+    print(comparison)
+
 # ================= SAVE =================
 
-joblib.dump(model, "kdefender_ai.pkl")
-print("\nModel saved as kdefender_ai.pkl")
+# written next to the current model first: it is only replaced if the gate passes
+new_pkl = MODEL_NAME + ".new.pkl"
+new_npz = MODEL_NAME + ".new.npz"
+joblib.dump(model, new_pkl)
+
+# Компактный артефакт для NumPy-скорера в core.py (без sklearn и pickle)
+export_native_model(model, new_npz, coef_dtype=args.coef_dtype)
+native_diff = np.abs(
+    NativeScorer(new_npz).predict_proba(X_test[:1000])
+    - model.predict_proba(X_test[:1000])
+).max()
+print("\nNative model max proba diff: %.2e" % native_diff)
+
+# ================= PERFORMANCE =================
+
+print("Benchmarking inference...")
+bench_texts = list(X_test[:args.bench_samples])
+perf = {
+    "new (npz)": measure(new_npz, bench_texts, args.bench_batch),
+    "new (pkl)": measure(new_pkl, bench_texts, args.bench_batch),
+}
+current = None
+if os.path.exists(MODEL_NAME + ".npz"):
+    current = perf["current (npz)"] = measure(MODEL_NAME + ".npz", bench_texts, args.bench_batch)
+
+# core.py serves the native artifact: that's what the gate looks at
+gate_failures = check_gate(perf["new (npz)"], current, args.gate_ratio or None, args.gate_p99_ms)
+perf_table = format_bench(perf)
+
+print("\n=== Inference performance (batch %d) ===" % args.bench_batch)
+print(perf_table)
 
 with open("training_report.txt", "w", encoding="utf-8") as f:
-    f.write("Samples: " + str(len(texts)) + "\n\n")
+    f.write("Samples: " + str(n_samples) + "\n\n")
     f.write(report)
     f.write("\nConfusion Matrix:\n")
     f.write(str(cm))
+    if comparison:
+        f.write("\n\nHashed vs vocabulary model:\n")
+        f.write(comparison)
+    if sweep_table:
+        f.write("\n\nSweep (validation slice of the train set):\n")
+        f.write(sweep_table)
+    f.write("\n\nInference performance (batch %d):\n" % args.bench_batch)
+    f.write(perf_table)
+    f.write("\n\nLatency gate: " + ("FAILED\n  " + "\n  ".join(gate_failures) if gate_failures else "passed") + "\n")
 
 print("Report saved to training_report.txt")
+
+if gate_failures:
+    os.remove(new_pkl)
+    os.remove(new_npz)
+    print("\nLatency gate failed, model NOT saved:")
+    for failure in gate_failures:
+        print("  " + failure)
+    sys.exit(1)
+
+os.replace(new_pkl, MODEL_NAME + ".pkl")
+os.replace(new_npz, MODEL_NAME + ".npz")
+print("Model saved as %s.pkl and %s.npz" % (MODEL_NAME, MODEL_NAME))
+
+if args.publish:
+    version = publish([MODEL_NAME + ".npz", MODEL_NAME + ".pkl", "training_report.txt"])
+    print("Published model version " + version)
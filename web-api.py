@@ -1,71 +1,164 @@
 from os import utime
+import os
 import ipaddress
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, request, jsonify, abort
 from core import *
-from normalization import normalize_input
+import core
+from klog import get_logger, dropped_count
+from normalization import get_transform_stats
+import alert_bus
 import time
 
 app = Flask(__name__)
 logs_num = 5000
+log = get_logger("api")
+
+# === Process pool for normalization/detection ===
+# normalize_input and the detectors are pure-Python CPU work and hold the GIL,
+# so large inputs are sent to warm worker processes.
+POOL_WORKERS = int(os.getenv("KDEFENDER_POOL_WORKERS", "0"))    # 0 -> always inline
+POOL_MIN_LEN = int(os.getenv("KDEFENDER_POOL_MIN_LEN", "512"))  # shorter -> inline (IPC costs more)
+
+_pool = None
+_pool_lock = threading.Lock()
+_worker_transform_stats = {}  # accumulated from pool workers
+_worker_stats_lock = threading.Lock()
+
+ready = False  # set once the model is warmed, /status/ answers 503 until then
+_startup_lock = threading.Lock()
 
 TG_NETS = [
     ipaddress.ip_network("149.154.160.0/20"),
     ipaddress.ip_network("91.108.4.0/22"),
 ] # https://core.telegram.org/bots/webhooks <-- there are Telegram IPs
 
+def get_pool():
+    global _pool
+    if POOL_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, initializer=core.init_pool_worker)
+            # start all workers now so the first checks don't pay for the spawn
+            for f in [_pool.submit(warm_up) for _ in range(POOL_WORKERS)]:
+                f.result()
+    return _pool
+
+def _drop_pool(pool):
+    # a worker died (OOM kill, segfault): the executor is unusable, the next get_pool() makes a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+    log.warning("pool_broken", workers=POOL_WORKERS)
+
+def analyze(text, detect=True, disabled_decoders=(), cascade=None):
+    pool = get_pool()
+    if pool is None or len(text) < POOL_MIN_LEN:
+        return analyze_text(text, detect, disabled_decoders, cascade)
+    try:
+        result, stats = pool.submit(core.analyze_text_in_worker, text, detect, disabled_decoders, cascade).result()
+    except BrokenProcessPool:
+        _drop_pool(pool)
+        return analyze_text(text, detect, disabled_decoders, cascade)  # this check inline
+    if stats:
+        with _worker_stats_lock:
+            _merge_transform_stats(_worker_transform_stats, stats)
+    return result
+
+def _merge_transform_stats(dst, src):
+    for name, st in src.items():
+        acc = dst.setdefault(name, {"tried": 0, "succeeded": 0, "outputs": 0, "time": 0.0})
+        for k, v in st.items():
+            acc[k] = acc.get(k, 0) + v
+    return dst
+
+def transform_stats():
+    # workers hand their counters over with every result (analyze), nothing to wait for here
+    merged = get_transform_stats()
+    with _worker_stats_lock:
+        _merge_transform_stats(merged, _worker_transform_stats)
+    return merged
+
+def startup():
+    """
+    Model warm-up, worker pool and state compactor, once per process.
+    python web-api.py runs it before serving; under flask run / a WSGI server
+    the first request does (a /status/ probe starts it in the background).
+    """
+    global ready
+    if ready:
+        return
+    with _startup_lock:
+        if ready:
+            return
+        warm_up()   # load the model once, forked workers share its pages
+        get_pool()  # fork workers before the server starts its threads (when run directly)
+        store.start_compactor()  # state journal -> snapshot in the background
+        ready = True
+        log.info("api_ready", model=core.model_version, pool_workers=POOL_WORKERS)
+
+@app.before_request
+def _startup_on_first_request():
+    if ready:
+        return
+    if request.endpoint == "status":
+        threading.Thread(target=startup, daemon=True).start()  # answers 503 until warm
+        return
+    startup()
+
 @app.route("/")
 def index():
     return "ok"
 
-def blocked(bot, text, normalized, reason, score, cur_time=None):
+def blocked(text, normalized, reason, score, cur_time=None):
     if cur_time is None: cur_time = time.time()
-    bot.setdefault("pending", {}).setdefault("alert", []).append({
+    return {
         "text": text,
         "normal": normalized,
         "reason": reason,
         "score": score,
         "time": cur_time
-    })
-    save_json(STATE_FILE, state)
+    }
 
 
 @app.route("/check/", methods=["POST"])
 def check():
-    global state
-    state = load_json(STATE_FILE, state)
-
     data = request.get_json(force=True)
 
     bot_id = str(data.get("bot_id", ""))
     token = data.get("token", "")
     text = data.get("text", "")
+    # Telegram ids of the end user (newer wrappers): flood is counted per sender
+    sender = data.get("user_id", data.get("chat_id"))
 
     # === Find bot ===
-    owner_id = None
-    bot = None
-
-    for uid, u in state.items():
-        if bot_id in u.get("bots", {}):
-            bot = u["bots"][bot_id]
-            owner_id = uid
-            break
+    owner_id, user, bot = store.find_bot(bot_id)
 
     if not bot:
         return jsonify(result="blocked", score=100, reason=["BOT_NOT_FOUND"])
 
     # === Token check ===
     if token != bot.get("bot_token"):
-        bot["stats_total"] += 1
-        bot["stats_blocked"] += 1
-        save_json(STATE_FILE, state)
-        blocked(bot, text, "", ["INVALID_TOKEN"], 100)
+        store.record_check(owner_id, bot_id, alert=blocked(text, "", ["INVALID_TOKEN"], 100), blocked=1)
+        alert_bus.notify()
         return jsonify(result="blocked", score=100, reason=["INVALID_TOKEN"])
 
-    user = state[owner_id]
     user_settings = user["settings"]
     bot_settings = bot["settings"]
 
-    normalized = normalize_input(text)
+    detect = (
+        user_settings.get("enabled", True)
+        and user_settings.get("mode") not in ("allow_all", "block_all")
+    )
+    # decoders from normalization's registry switched off for this bot
+    disabled_decoders = tuple(bot.get("disabled_decoders", []))
+    cascade = make_cascade(user_settings, bot)
+    normalized, content_report, version = analyze(text, detect, disabled_decoders, cascade)
 
     # === Global modes ===
     if not user_settings.get("enabled", True):
@@ -81,7 +174,11 @@ def check():
         report = detect_injection(
             uid=owner_id,
             bot_id=bot_id,
-            text=normalized
+            text=normalized,
+            content_report=content_report,
+            sender=sender,
+            user=user,
+            bot=bot
         )
 
         report = {
@@ -91,52 +188,58 @@ def check():
 
         score = get_risk_score(report)
 
-        threshold = 30 if user_settings.get("strict") else 50
+        threshold = block_threshold(user_settings)
         reason = list(report.keys())
 
         status = "blocked" if score >= threshold else "ok"
 
-    bot["stats_total"] += 1
-    if status == "blocked":
-        bot["stats_blocked"] += 1
-
     cur_time = time.time()
 
-    bot.setdefault("logs", [])
-    bot["logs"].append({
-        "text": text,
-        "normalized": normalized,
-        "score": score,
-        "reason": reason,
-        "status": status,
-        "time": cur_time
-    })
-
-    global logs_num
-    bot["logs"] = bot["logs"][-logs_num:]
-
-    save_json(STATE_FILE, state)
-
+    # stats, log entry and alert: one storage write
+    store.record_check(
+        owner_id, bot_id,
+        entry={
+            "text": text,
+            "normalized": normalized,
+            "score": score,
+            "reason": reason,
+            "status": status,
+            "time": cur_time
+        },
+        alert=blocked(text, normalized, reason, score, cur_time) if status == "blocked" else None,
+        blocked=int(status == "blocked"),
+        keep=logs_num
+    )
     if status == "blocked":
-        blocked(bot, text, normalized, reason, score, cur_time)
+        alert_bus.notify()  # wake the bot: the alert is already in storage
 
     return jsonify(
         result=status,
         score=score,
-        reason=reason
+        reason=reason,
+        model=version
     )
 
 
 @app.route("/status/", methods=["GET"])
 def status():
+    if not ready:
+        return jsonify(result="starting"), 503
     return jsonify(result="ok")
 
+@app.route("/metrics/", methods=["GET"])
+def metrics():
+    return jsonify(
+        model=core.model_version,
+        transforms=transform_stats(),
+        ai_batch_sizes=ai_queue.stats(),
+        log_dropped=dropped_count()
+    )
+
 @app.route("/webhook/<secret>/", methods=["POST"])
 def webhook(secret):
     update = request.get_json(force=True)
-    global state
-    state = load_json(STATE_FILE, state)
-    for uid, user in state.items():
+    for uid, user in store.load_state().items():
         for bot_id, bot in user.get("bots", {}).items():
             ip_str = request.headers.get("X-Real-IP", request.remote_addr or "")
             try:
@@ -149,12 +252,13 @@ def webhook(secret):
             update.get("message", {}).get("text", "") == f"/verify_webhook {secret}" and
             any(ip in net for net in TG_NETS) and 
              not bot.get("verified", False)):
-                bot["verified"] = True
-                bot.setdefault("pending", {}).setdefault("info", []).append({
+                store.update_bot(uid, bot_id, verified=True)
+                store.push_pending(uid, bot_id, "info", {
                     "text": "Webhook verified"
                 })
-    save_json(STATE_FILE, state)
+                alert_bus.notify()
     return jsonify(result="ok")
 
 if __name__ == "__main__":
+    startup()
     app.run("127.0.0.1", 8001)